@@ -1,10 +1,15 @@
-from datetime import datetime
-import traceback
-from uuid import uuid4
+from collections import OrderedDict, deque
+from math import ceil
+from hashlib import sha1
+import json
+from time import time, perf_counter
 
 # Import twisted libraries
-from twisted.internet.defer import inlineCallbacks, maybeDeferred, Deferred
-from twisted.internet.task import LoopingCall
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, Deferred, DeferredList, succeed
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall, Cooperator, TaskStopped
+from twisted.python.failure import Failure
+import treq
 
 from yombo.core.exceptions import YomboWarning
 from yombo.core.module import YomboModule
@@ -18,6 +23,9 @@ from yombo.constants.features import (FEATURE_BRIGHTNESS, FEATURE_SEND_UPDATES,
 from yombo.constants.platforms import (PLATFORM_COLOR_LIGHT, PLATFORM_LIGHT, PLATFORM_FAN, PLATFORM_APPLIANCE,
     PLATFORM_SWITCH, PLATFORM_LOCK, PLATFORM_TV)
 
+from yombo.modules.amazonalexa import codec
+from yombo.modules.amazonalexa.responses import ResponseBuilder
+from yombo.modules.amazonalexa.stats import DeviceLatencies, DirectiveStats
 from yombo.modules.amazonalexa.web_routes import module_amazonalexa_routes
 logger = get_logger("modules.amazonalexa")
 
@@ -26,6 +34,73 @@ API_TEMP_UNITS = {
     'c': 'CELSIUS',
 }
 
+# All scene endpoints share these capabilities, they must not be modified.
+SCENE_CAPABILITIES = (
+    {
+        "type": "AlexaInterface",
+        "interface": "Alexa",
+        "version": "3"
+    },
+    {
+        "type": "AlexaInterface",
+        "interface": "Alexa.SceneController",
+        "version": "3",
+        "supportsDeactivation": True,
+        "proactivelyReported": False
+    },
+    {
+        "type": "AlexaInterface",
+        "interface": "Alexa.EndpointHealth",
+        "version": "3",
+        "properties": {
+            "supported": [
+                {
+                    "name": "connectivity"
+                }
+            ],
+            "proactivelyReported": True,
+            "retrievable": True
+        }
+    }
+)
+
+
+# Directive priority classes, lower numbers are handled first and rejected last when busy.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+DIRECTIVE_PRIORITIES = {
+    'Alexa.LockController': PRIORITY_HIGH,
+    'Alexa.SceneController': PRIORITY_HIGH,
+    'Alexa': PRIORITY_LOW,  # ReportState polls.
+}
+
+# Directives whose commands are coalesced by the command scheduler, last write wins. These come in
+# streams, such as dragging a slider, so they aren't limited by the per endpoint rate limit.
+COALESCED_DIRECTIVES = frozenset((
+    ('Alexa.BrightnessController', 'SetBrightness'),
+    ('Alexa.ColorController', 'SetColor'),
+))
+
+
+def freeze_features(features):
+    """
+    Returns a hashable, order independent copy of a device's FEATURES dictionary.
+
+    :param features: Dictionary of features.
+    :return: frozenset
+    """
+    def freeze(value):
+        if isinstance(value, dict):
+            return frozenset((key, freeze(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(item) for item in value)
+        if isinstance(value, set):
+            return frozenset(freeze(item) for item in value)
+        return value
+    return freeze(features)
+
+
 class AmazonAlexa(YomboModule):
     """
     Amazon Alexa allows you to control your devices through Alexa.
@@ -56,6 +131,7 @@ class AmazonAlexa(YomboModule):
         self.fqdn = self._Configs.get('dns', 'fqdn', None, False)
         self.port = self._Configs.get('webinterface', 'secure_port', None, False)
         self.module_enabled = self.is_master
+        self.debug_directives = self._Configs.get('amazonalexa', 'debug_directives', False, False)
         if self.fqdn is None:
             logger.warn("Amazon Alexa disabled, requires domain name to work.")
             self._Notifications.add({'title': 'Alexa disabled',
@@ -71,7 +147,33 @@ class AmazonAlexa(YomboModule):
             self.module_enabled = False
         self.node = None
         self.working = True
+        self.stopping = False
         self.discovery_loop = None
+        self.discovery_fingerprints = {}  # endpoint_id -> fingerprint the current endpoint was built from.
+        self.discovery_global_fingerprint = None
+        self.discovery_task = None  # CooperativeTask of the running discovery.
+        self.discovery_queued = None  # Discovery requested to run next, see discovery().
+        self.discovery_progress = {'running': False, 'done': 0, 'total': 0}
+        self.discovery_pending = {'device_ids': set(), 'scene_ids': set(), 'first': None, 'timer': None}
+        # Each cooperative step is a full time slice, the next slice runs on the next reactor iteration.
+        self.discovery_cooperator = Cooperator(terminationPredicateFactory=lambda: lambda: True,
+                                               scheduler=lambda step: reactor.callLater(0, step))
+        self.capability_cache = _LRUCache(256)  # (platform, frozen features) -> capabilities tuple.
+        self.allowed_devices = None  # _AllowList of device_ids, setup once the node is loaded.
+        self.allowed_scenes = None  # _AllowList of scene_ids.
+        self.state_cache = _StateCache()  # Last known properties of each endpoint, used for ReportState.
+        self.event_sender = self.send_events  # Callable that delivers events to Alexa, receives a list of events.
+        self.change_reporter = None
+        self.persister = None  # _NodePersister, saves the node after changes.
+        self.endpoint_sync = None  # _EndpointSync, sends endpoint changes to Yombo as deltas, if enabled.
+        self.directive_stats = DirectiveStats()  # Latency histograms for each stage of processing directives.
+        self.stats_key = None  # Directive being handled, so nested stages are recorded against it.
+        self.responses = ResponseBuilder()
+        self.idempotency_cache = _IdempotencyCache()  # Responses of recent directives, for retries.
+        self.circuit_breakers = _CircuitBreakers(self)  # Fails fast for unreachable devices and gateways.
+        self.command_scheduler = _CommandScheduler(self)  # Orders device commands, see send_command().
+        self.admission_control = _AdmissionControl(self.command_scheduler)  # Rejects directives when busy.
+        self.directive_priority = PRIORITY_NORMAL  # Priority of the directive being handled.
         self.response_handlers = {
             'Alexa.BrightnessController': {
                 'AdjustBrightness': self.api_undefined,
@@ -122,10 +224,16 @@ class AmazonAlexa(YomboModule):
                 'SetMute': self.api_undefined,
             },
             'Alexa': {
-                'ReportState': self.api_undefined,
+                'ReportState': self.api_report_state,
             },
         }
-        self.pending_commands = []
+        # Flat (namespace, name) -> handler lookup, shared by every resolved endpoint.
+        self.handler_table = {(namespace, name): handler
+                              for namespace, handlers in self.response_handlers.items()
+                              for name, handler in handlers.items()}
+        self.resolved_endpoints = {}  # endpoint_id -> _ResolvedEndpoint
+        self.pending_commands = {}  # request_id -> dict, commands waiting to send a deferred response.
+        self.pending_commands_loop = None
 
     def _load_(self, **kwargs):
         if self.is_master is False or self.module_enabled is False:
@@ -192,22 +300,92 @@ class AmazonAlexa(YomboModule):
             # print("amazon alex has node: %s - %s" % (node_id, node.data))
             # print("amazon alex has node: %s - %s" % (node_id, type(node.data)))
             self.node = node
-            if 'alexa' not in self.node.data:
-                self.node.data['alexa'] = {}
-            if 'devices' not in self.node.data:
-                self.node.data['devices'] = {}
-            if 'allowed' not in self.node.data['devices']:
-                self.node.data['devices']['allowed'] = []
-            if 'configs' not in self.node.data:
-                self.node.data['configs'] = {}
-            if 'scenes' not in self.node.data:
-                self.node.data['scenes'] = {}
-            if 'allowed' not in self.node.data['scenes']:
-                self.node.data['scenes']['allowed'] = []
             break
 
-        self.discovery_loop = LoopingCall(self.discovery)
-        self.discovery_loop.start(random_int(60 * 60 * 12, .25))
+        if self.working is False:
+            return
+
+        self.load_node_data()
+
+        # Discovery is triggered by device and scene changes, this is only a consistency sweep.
+        self.discovery().addErrback(self.discovery_errback)
+        self.discovery_loop = LoopingCall(self.scheduled_discovery)
+        self.discovery_loop.start(random_int(60 * 60 * 24, .25), False)
+        self.pending_commands_loop = LoopingCall(self.expire_pending_commands)
+        self.pending_commands_loop.start(30, False)
+
+    def load_node_data(self):
+        """
+        Sets defaults for anything missing in the node, and sets up the items that depend on the node.
+        """
+        if 'alexa' not in self.node.data:
+            self.node.data['alexa'] = {}
+        if 'devices' not in self.node.data:
+            self.node.data['devices'] = {}
+        if 'allowed' not in self.node.data['devices']:
+            self.node.data['devices']['allowed'] = []
+        if 'configs' not in self.node.data:
+            self.node.data['configs'] = {}
+        if 'scenes' not in self.node.data:
+            self.node.data['scenes'] = {}
+        if 'allowed' not in self.node.data['scenes']:
+            self.node.data['scenes']['allowed'] = []
+
+        configs = self.node.data['configs']
+        try:
+            codec.use_backend(configs.get('json_backend'))
+        except KeyError as e:
+            logger.warn("{error} Using: {backend}", error=e.args[0], backend=codec.use_backend())
+        if configs.get('delta_sync', False) is True:
+            self.endpoint_sync = _EndpointSync(self)
+            sync_handlers = {'alexa': self.endpoint_sync.sync}
+        else:
+            self.endpoint_sync = None
+            sync_handlers = None
+        self.persister = _NodePersister(self.node,
+                                        debounce=configs.get('save_debounce', 5),
+                                        min_interval=configs.get('save_min_interval', 30),
+                                        sync_handlers=sync_handlers,
+                                        )
+        self.allowed_devices = _AllowList(self.node.data['devices'],
+                                          on_change=lambda: self.persister.mark_dirty('devices'))
+        self.allowed_scenes = _AllowList(self.node.data['scenes'],
+                                         on_change=lambda: self.persister.mark_dirty('scenes'))
+        self.change_reporter = _ChangeReporter(self,
+                                               window=configs.get('change_report_window', 2),
+                                               max_batch=configs.get('change_report_batch', 50),
+                                               )
+        self.command_scheduler.max_in_flight = configs.get('command_max_in_flight', 20)
+        latencies = self.command_scheduler.latencies
+        latencies.default_timeout = configs.get('command_timeout', 5)
+        latencies.min_timeout = configs.get('command_timeout_min', 1)
+        latencies.max_timeout = configs.get('command_timeout_max', 60)
+        latencies.multiplier = configs.get('command_timeout_multiplier', 2)
+        self.command_scheduler.max_queued = configs.get('command_max_queued', 500)
+        self.command_scheduler.max_device_depth = configs.get('command_max_device_depth', 10)
+        self.circuit_breakers.failure_threshold = configs.get('breaker_failures', 3)
+        self.circuit_breakers.gateway_failure_threshold = configs.get('breaker_gateway_failures', 10)
+        self.circuit_breakers.reset_timeout = configs.get('breaker_reset', 30)
+        self.admission_control.configure(rate=configs.get('rate_limit', 50),
+                                         burst=configs.get('rate_limit_burst', 100),
+                                         endpoint_rate=configs.get('endpoint_rate_limit', 5),
+                                         endpoint_burst=configs.get('endpoint_rate_limit_burst', 10),
+                                         )
+        self.idempotency_cache.maxsize = configs.get('idempotency_size', 1000)
+        self.idempotency_cache.ttl = configs.get('idempotency_ttl', 300)
+
+    def _stop_(self, **kwargs):
+        self.stopping = True
+        if self.discovery_loop is not None and self.discovery_loop.running:
+            self.discovery_loop.stop()
+        if self.discovery_pending['timer'] is not None and self.discovery_pending['timer'].active():
+            self.discovery_pending['timer'].cancel()
+        if self.discovery_task is not None:
+            self.discovery_task.stop()
+        if self.change_reporter is not None:
+            self.change_reporter.flush()
+        if self.persister is not None:
+            return self.persister.flush(full=True)
 
     def _event_types_(self, **kwargs):
         """
@@ -230,6 +408,137 @@ class AmazonAlexa(YomboModule):
             },
         }
 
+    def _device_added_(self, **kwargs):
+        """
+        A new device was added, check if it should be sent to Alexa.
+        """
+        self.device_changed(**kwargs)
+
+    def _device_updated_(self, **kwargs):
+        """
+        Called when a device is edited: renamed, enabled/disabled, features changed, etc.
+        """
+        self.device_changed(**kwargs)
+
+    def _device_deleted_(self, **kwargs):
+        self.device_changed(**kwargs)
+
+    def _scene_added_(self, **kwargs):
+        self.scene_changed(**kwargs)
+
+    def _scene_edited_(self, **kwargs):
+        self.scene_changed(**kwargs)
+
+    def _scene_deleted_(self, **kwargs):
+        self.scene_changed(**kwargs)
+
+    def device_changed(self, **kwargs):
+        """
+        Queue discovery for a device that was added, edited or deleted.
+        """
+        device_id = kwargs.get('device_id')
+        if device_id is None:
+            device_id = kwargs['device'].device_id
+        self.resolved_endpoints.pop(device_id, None)
+        self.state_cache.remove(device_id)
+        self.queue_discovery(device_ids=(device_id,))
+
+    def scene_changed(self, **kwargs):
+        """
+        Queue discovery for a scene that was added, edited or deleted.
+        """
+        scene_id = kwargs.get('scene_id')
+        if scene_id is None:
+            scene_id = kwargs['scene'].scene_id
+        self.resolved_endpoints.pop(scene_id, None)
+        self.state_cache.remove(scene_id)
+        self.queue_discovery(scene_ids=(scene_id,))
+
+    def queue_discovery(self, device_ids=(), scene_ids=()):
+        """
+        Collects items to discover, and runs discovery once things settle down. Each new item restarts
+        the debounce window (configs: discovery_debounce), but discovery isn't delayed longer than
+        discovery_max_wait seconds from the first queued item.
+
+        :param device_ids: Iterable of device ids that changed.
+        :param scene_ids: Iterable of scene ids that changed.
+        """
+        if self.module_enabled is False or self.node is None or self.allowed_devices is None:
+            return
+        pending = self.discovery_pending
+        pending['device_ids'].update(device_ids)
+        pending['scene_ids'].update(scene_ids)
+
+        configs = self.node.data['configs']
+        now = time()
+        if pending['first'] is None:
+            pending['first'] = now
+        delay = min(configs.get('discovery_debounce', 5),
+                    pending['first'] + configs.get('discovery_max_wait', 60) - now)
+        if pending['timer'] is not None and pending['timer'].active():
+            pending['timer'].reset(max(0, delay))
+        else:
+            pending['timer'] = reactor.callLater(max(0, delay), self.run_queued_discovery)
+
+    def run_queued_discovery(self):
+        pending = self.discovery_pending
+        device_ids = pending['device_ids']
+        scene_ids = pending['scene_ids']
+        pending.update({'device_ids': set(), 'scene_ids': set(), 'first': None, 'timer': None})
+        return self.discovery(device_ids=device_ids, scene_ids=scene_ids).addErrback(self.discovery_errback)
+
+    def scheduled_discovery(self):
+        """
+        Called by the discovery loop. Errors are logged here so a failed run doesn't stop the loop.
+        """
+        return self.discovery().addErrback(self.discovery_errback)
+
+    def discovery_errback(self, failure):
+        logger.warn("Alexa discovery didn't complete: {error}", error=failure.getErrorMessage())
+
+    def _device_status_(self, **kwargs):
+        """
+        Keeps the state cache current whenever an allowed device's status changes.
+
+        :param kwargs:
+        :return:
+        """
+        if self.module_enabled is False or self.allowed_devices is None:
+            return
+        device = kwargs['device']
+        if device.device_id not in self.allowed_devices:
+            return
+        context = self.update_state_cache(device.device_id, device)
+        if self.change_reporter is not None:
+            self.change_reporter.report(device.device_id, context)
+
+    def send_events(self, events):
+        """
+        Default event sender, delivers events (ChangeReport, etc) to Alexa. If 'events_url' is set
+        in the node configs, events are posted there instead of to Yombo, useful for testing.
+
+        :param events: List of events, as generated by api_message().
+        :return: Deferred
+        """
+        url = self.node.data['configs'].get('events_url')
+        if url is not None:
+            return treq.post(url,
+                             codec.encode({'events': events}),
+                             headers={'Content-Type': ['application/json']},
+                             )
+        return self._YomboAPI.request('POST', '/v1/alexa/events', {'events': events})
+
+    def endpoint_sync_sender(self, payload):
+        """
+        Sends an endpoint sync payload from _EndpointSync to Yombo.
+
+        :param payload: Full document or patch.
+        :return: Deferred that fires with the version Yombo now has.
+        """
+        d = self._YomboAPI.request('PATCH', '/v1/node/%s/alexa' % self.node.node_id, payload)
+        d.addCallback(lambda response: (response.get('content') or {}).get('version'))
+        return d
+
     def _webinterface_add_routes_(self, **kwargs):
         """
         Add web interface routes.
@@ -315,7 +624,7 @@ class AmazonAlexa(YomboModule):
                 }
             }
 
-    def discovery(self, save=None):
+    def discovery(self, save=None, device_ids=None, scene_ids=None):
         """
         Discovers all device within the current cluster and sends them to Yombo. Alexa will periodically fetch from
         Yombo servers, even if this gateway is offline or not accessible when Alexa asks for devices.
@@ -326,35 +635,301 @@ class AmazonAlexa(YomboModule):
         If for some reason someone decides to mangle this, Alexa will get a managed response and not smart home
         devices will work through Alexa.
 
-        :return:
+        Discovery is incremental: each endpoint has a fingerprint of the attributes used to build it. Only
+        endpoints with a changed fingerprint are regenerated, and node.data['alexa'] is updated in place.
+
+        If device_ids or scene_ids are provided, only those items are checked instead of the entire
+        device and scene registries.
+
+        Discovery runs cooperatively in time slices (configs: discovery_slice_ms) so the reactor is never
+        blocked for long. If discovery is already running, another run is queued to start once it finishes,
+        multiple requests made while running are merged into that single run.
+
+        :param save: If False, don't save the node, even if something changed.
+        :param device_ids: Optional iterable of device ids to limit discovery to.
+        :param scene_ids: Optional iterable of scene ids to limit discovery to.
+        :return: Deferred that fires with a dictionary of endpoint id lists: added, changed, removed.
+        """
+        if self.module_enabled is False or self.stopping:
+            return succeed(None)
+
+        d = Deferred()
+        if self.discovery_queued is None:
+            self.discovery_queued = {
+                'save': save,
+                'full': False,
+                'device_ids': set(),
+                'scene_ids': set(),
+                'deferreds': [],
+            }
+        queued = self.discovery_queued
+        if device_ids is None and scene_ids is None:
+            queued['full'] = True
+        else:
+            queued['device_ids'].update(device_ids or ())
+            queued['scene_ids'].update(scene_ids or ())
+        if save is not False:
+            queued['save'] = save
+        queued['deferreds'].append(d)
+
+        if self.discovery_task is None:
+            self.start_discovery()
+        return d
+
+    def start_discovery(self):
+        """
+        Starts the queued discovery run as a cooperative task.
+        """
+        queued = self.discovery_queued
+        self.discovery_queued = None
+        if queued['full']:
+            device_ids = None
+            scene_ids = None
+        else:
+            device_ids = queued['device_ids']
+            scene_ids = queued['scene_ids']
+
+        delta = {'added': [], 'changed': [], 'removed': []}
+        budget = self.node.data['configs'].get('discovery_slice_ms', 10) / 1000.0
+        steps = self.discovery_steps(delta, queued['save'], device_ids, scene_ids, budget)
+        self.discovery_task = self.discovery_cooperator.cooperate(steps)
+        self.discovery_task.whenDone().addBoth(self.discovery_finished, delta, queued['deferreds'])
+
+    def discovery_finished(self, result, delta, deferreds):
+        self.discovery_task = None
+        self.discovery_progress['running'] = False
+        if isinstance(result, Failure) and result.check(TaskStopped):
+            # Stopped by _stop_, the gateway is shutting down. Waiters get whatever was done so far.
+            logger.debug("Alexa discovery stopped before it finished.")
+            result = None
+        if isinstance(result, Failure):
+            logger.error("Alexa discovery failed: {error}", error=result.getErrorMessage())
+            for d in deferreds:
+                d.errback(result)
+        else:
+            for d in deferreds:
+                d.callback(delta)
+        if self.discovery_queued is not None:
+            if self.stopping is False:
+                self.start_discovery()
+            else:
+                queued = self.discovery_queued
+                self.discovery_queued = None
+                for d in queued['deferreds']:
+                    d.callback(None)
+
+    def discover_now(self, save=None, device_ids=None, scene_ids=None):
+        """
+        Run discovery synchronously, without yielding to the reactor. Same arguments as discovery().
+
+        :return: A dictionary of endpoint id lists: added, changed, removed.
         """
         if self.module_enabled is False:
             return
+        delta = {'added': [], 'changed': [], 'removed': []}
+        for step in self.discovery_steps(delta, save, device_ids, scene_ids, budget=None):
+            pass
+        self.discovery_progress['running'] = False
+        return delta
 
-        endpoints = {}
-        for device_id, device in self._Devices.devices.items():
-            # print("alexa: doing device: %s - %s" % (device.label, device.enabled_status))
-            if device_id not in self.node.data['devices']['allowed'] or device.enabled_status != 1:
-                continue
-            # print("alexa device has good status: %s" % device.label)
-            try:
-                endpoints[device_id] = self.generate_device_endpoint(device)
-            except YomboWarning as e:
-                logger.warn("{e}", e=e)
-
-        for scene_id, scene in self._Scenes.scenes.items():
-            if scene_id not in self.node.data['scenes']['allowed'] or scene.effective_status() != 1:
-                continue
-            # print("alexa device has good status: %s" % device.label)
-            try:
-                endpoints[scene_id] = self.generate_scene_endpoint(scene)
-            except YomboWarning as e:
-                logger.warn("{e}", e=e)
-
-        # print("alexa endpoints: %s" % json.dumps(endpoints))
-        self.node.data['alexa'] = endpoints
-        if save is not False:
-            self.node.save()
+    def discovery_steps(self, delta, save, device_ids, scene_ids, budget):
+        """
+        Generator that does the actual discovery work, yielding whenever the time budget for the current
+        slice is used up. Results are recorded into delta.
+
+        :param delta: Dictionary of added, changed and removed lists to record the results into.
+        :param save: If False, don't save the node, even if something changed.
+        :param device_ids: Optional iterable of device ids to limit discovery to.
+        :param scene_ids: Optional iterable of scene ids to limit discovery to.
+        :param budget: Seconds each slice may run for, None to never yield.
+        :return:
+        """
+        started = perf_counter()
+        endpoints = self.node.data['alexa']
+
+        global_fingerprint = (self.authkey.auth_id, self.fqdn, self.port)
+        if global_fingerprint != self.discovery_global_fingerprint:
+            self.discovery_fingerprints.clear()
+            self.discovery_global_fingerprint = global_fingerprint
+            device_ids = None
+            scene_ids = None
+
+        full_sweep = device_ids is None and scene_ids is None
+        if full_sweep:  # Copies, the registries may change while discovery yields.
+            devices = list(self._Devices.devices.items())
+            scenes = list(self._Scenes.scenes.items())
+        else:
+            devices = self.registry_items(self._Devices.devices, device_ids)
+            scenes = self.registry_items(self._Scenes.scenes, scene_ids)
+
+        progress = self.discovery_progress
+        progress.update({'running': True, 'started': time(), 'done': 0, 'total': len(devices) + len(scenes),
+                         'slices': 1})
+        slice_ends = None if budget is None else perf_counter() + budget
+
+        seen = set()
+        allowed_devices = self.allowed_devices
+        for device_id, device in devices:
+            seen.add(device_id)
+            if device is None or device_id not in allowed_devices or device.enabled_status != 1:
+                fingerprint = None
+            else:
+                fingerprint = self.device_fingerprint(device)
+            self.discover_endpoint(device_id, fingerprint, self.generate_device_endpoint, device, delta)
+            progress['done'] += 1
+            if slice_ends is not None and perf_counter() > slice_ends:
+                yield
+                progress['slices'] += 1
+                slice_ends = perf_counter() + budget
+
+        allowed_scenes = self.allowed_scenes
+        for scene_id, scene in scenes:
+            seen.add(scene_id)
+            if scene is None or scene_id not in allowed_scenes or scene.effective_status() != 1:
+                fingerprint = None
+            else:
+                fingerprint = self.scene_fingerprint(scene)
+            self.discover_endpoint(scene_id, fingerprint, self.generate_scene_endpoint, scene, delta)
+            progress['done'] += 1
+            if slice_ends is not None and perf_counter() > slice_ends:
+                yield
+                progress['slices'] += 1
+                slice_ends = perf_counter() + budget
+
+        if full_sweep:
+            for endpoint_id in [endpoint_id for endpoint_id in endpoints if endpoint_id not in seen]:
+                del endpoints[endpoint_id]
+                self.discovery_fingerprints.pop(endpoint_id, None)
+                delta['removed'].append(endpoint_id)
+
+        for endpoint_id in delta['removed']:
+            self.resolved_endpoints.pop(endpoint_id, None)
+            self.state_cache.remove(endpoint_id)
+            if self.change_reporter is not None:
+                self.change_reporter.forget(endpoint_id)
+
+        progress['duration'] = round(perf_counter() - started, 3)
+        if len(delta['added']) or len(delta['changed']) or len(delta['removed']):
+            logger.debug("Alexa discovery delta, added: {added}, changed: {changed}, removed: {removed}, "
+                         "slices: {slices}, seconds: {duration}",
+                         added=len(delta['added']), changed=len(delta['changed']), removed=len(delta['removed']),
+                         slices=progress['slices'], duration=progress['duration'])
+            if self.endpoint_sync is not None:
+                self.endpoint_sync.record(delta)
+            if save is not False:
+                self.persister.mark_dirty('alexa')
+
+    @staticmethod
+    def registry_items(registry, item_ids):
+        """
+        Returns item_id, item pairs for the requested ids from a device or scene registry. Items that
+        no longer exist are returned as None.
+
+        :param registry: Dictionary of devices or scenes.
+        :param item_ids: Iterable of ids, None for no items.
+        :return: List of tuples
+        """
+        if item_ids is None:
+            return []
+        return [(item_id, registry.get(item_id)) for item_id in item_ids]
+
+    def discover_endpoint(self, endpoint_id, fingerprint, generator, item, delta):
+        """
+        Regenerates a single endpoint if its fingerprint changed. A fingerprint of None means the
+        item should not be sent to Alexa, any existing endpoint will be removed.
+
+        :param endpoint_id: The device_id or scene_id.
+        :param fingerprint: Fingerprint from device_fingerprint() or scene_fingerprint().
+        :param generator: Callable to generate the endpoint, receives item.
+        :param item: The device or scene.
+        :param delta: Dictionary to record the added/changed/removed endpoint ids into.
+        :return:
+        """
+        endpoints = self.node.data['alexa']
+        fingerprints = self.discovery_fingerprints
+        if fingerprint is None:
+            fingerprints.pop(endpoint_id, None)
+            self.resolved_endpoints.pop(endpoint_id, None)
+            if endpoint_id in endpoints:
+                del endpoints[endpoint_id]
+                delta['removed'].append(endpoint_id)
+            return
+
+        if endpoint_id in endpoints and fingerprints.get(endpoint_id) == fingerprint:
+            return
+
+        self.resolved_endpoints.pop(endpoint_id, None)
+        self.state_cache.remove(endpoint_id)
+        try:
+            endpoint = generator(item)
+        except YomboWarning as e:
+            logger.warn("{e}", e=e)
+            fingerprints.pop(endpoint_id, None)
+            if endpoint_id in endpoints:
+                del endpoints[endpoint_id]
+                delta['removed'].append(endpoint_id)
+            return
+
+        fingerprints[endpoint_id] = fingerprint
+        if endpoint_id not in endpoints:
+            delta['added'].append(endpoint_id)
+        elif self.same_endpoint(endpoints[endpoint_id], endpoint):
+            return
+        else:
+            delta['changed'].append(endpoint_id)
+        endpoints[endpoint_id] = endpoint
+
+    @staticmethod
+    def same_endpoint(current, new):
+        """
+        Checks if two endpoints are the same. Endpoints loaded from the node have their capabilities as
+        a list, while generated endpoints use a shared tuple.
+
+        :param current:
+        :param new:
+        :return: bool
+        """
+        if current.keys() != new.keys():
+            return False
+        for key, value in new.items():
+            if key == 'capabilities':
+                if list(current[key]) != list(value):
+                    return False
+            elif current[key] != value:
+                return False
+        return True
+
+    @staticmethod
+    def device_fingerprint(device):
+        """
+        Returns a hashable fingerprint of everything generate_device_endpoint() uses to build an endpoint.
+
+        :param device:
+        :return:
+        """
+        return (
+            device.PLATFORM,
+            freeze_features(device.FEATURES),
+            device.full_label,
+            device.description,
+            device.device_mfg,
+            device.gateway_id,
+            device.enabled_status,
+        )
+
+    @staticmethod
+    def scene_fingerprint(scene):
+        """
+        Returns a hashable fingerprint of everything generate_scene_endpoint() uses to build an endpoint.
+
+        :param scene:
+        :return:
+        """
+        return (
+            scene.label,
+            scene.gateway_id,
+            scene.effective_status(),
+        )
 
     def generate_device_endpoint(self, device):
         """
@@ -363,28 +938,12 @@ class AmazonAlexa(YomboModule):
         :param device:
         :return:
         """
-        def endpoint_health():
-            return {
-                "type": "AlexaInterface",
-                "interface": "Alexa.EndpointHealth",
-                "version": "3",
-                "properties": {
-                    "supported": [
-                        {
-                            "name": "connectivity"
-                        }
-                    ],
-                    "proactivelyReported": False,
-                    "retrievable": False
-                }
-            }
-
         if device.PLATFORM in self.display_categories:
             display_category = self.display_categories[device.PLATFORM]
         else:
             display_category = 'OTHER'
 
-        endpoint = {
+        return {
             "endpointId": device.device_id,
             "manufacturerName": device.device_mfg,
             "friendlyName": device.full_label,
@@ -398,9 +957,67 @@ class AmazonAlexa(YomboModule):
                 "authkey": self.authkey.auth_id,
                 "uri": "https://e.%s:%s" % (self.fqdn, self.port)
             },
-            "capabilities": None,
+            "capabilities": self.device_capabilities(device),
         }
 
+    def device_capabilities(self, device):
+        """
+        Returns the capabilities for a device. Most devices share one of a handful of platform and
+        feature combinations, so the capabilities are cached and shared between endpoints. The returned
+        tuple must not be modified.
+
+        :param device:
+        :return: tuple of capability dictionaries.
+        """
+        try:
+            key = (device.PLATFORM, freeze_features(device.FEATURES))
+            capabilities = self.capability_cache.get(key)
+        except TypeError:  # Something within the features isn't hashable, don't cache it.
+            return self.build_device_capabilities(device.PLATFORM, device.FEATURES)
+
+        if capabilities is None:
+            capabilities = self.build_device_capabilities(device.PLATFORM, device.FEATURES)
+            self.capability_cache.set(key, capabilities)
+        return capabilities
+
+    @staticmethod
+    def build_device_capabilities(platform, features):
+        """
+        Builds the capabilities section of a device endpoint from a platform and its features.
+
+        :param platform: The device platform, such as 'light'.
+        :param features: The device FEATURES dictionary.
+        :return: tuple of capability dictionaries.
+        """
+        def controller_capability(controller_class):
+            # The flags come from the controller, so discovery matches what is reported and retrievable.
+            return {
+                "type": "AlexaInterface",
+                "interface": controller_class.NAMESPACE,
+                "version": "3",
+                "properties": {
+                    "supported": list(controller_class.PROPERTIES),
+                    "proactivelyReported": controller_class.PROACTIVELY_REPORTED,
+                    "retrievable": controller_class.RETRIEVABLE,
+                }
+            }
+
+        def endpoint_health():
+            return {
+                "type": "AlexaInterface",
+                "interface": "Alexa.EndpointHealth",
+                "version": "3",
+                "properties": {
+                    "supported": [
+                        {
+                            "name": "connectivity"
+                        }
+                    ],
+                    "proactivelyReported": True,
+                    "retrievable": True
+                }
+            }
+
         capabilities = [
             {
                 "type": "AlexaInterface",
@@ -409,13 +1026,12 @@ class AmazonAlexa(YomboModule):
             },
         ]
 
-        # print("device (%s-%s-%s) features: %s" % (device.label, device.PLATFORM, device.SUB_PLATFORM, device.features))
-        if device.PLATFORM == "climate":
+        if platform == "climate":
             supported = [
                 {"name": "thermostatMode"}
                 ]
-            if 'dual_setpoints' in device.FEATURES:
-                if 'dual_setpoitns' in device.FEATURES and device.FEATURES['dual_setpoints'] is True:
+            if 'dual_setpoints' in features:
+                if 'dual_setpoitns' in features and features['dual_setpoints'] is True:
                     supported.append({"name":"upperSetpoint"})
                     supported.append({"name":"lowerSetpoint"})
                 else:
@@ -434,7 +1050,7 @@ class AmazonAlexa(YomboModule):
                 }
             })
 
-        elif device.PLATFORM == 'scene':
+        elif platform == 'scene':
                 capabilities.append({
                 "type": "AlexaInterface",
                 "interface": "Alexa.SceneController",
@@ -445,7 +1061,7 @@ class AmazonAlexa(YomboModule):
                 }
             })
 
-        elif device.PLATFORM == 'camera':
+        elif platform == 'camera':
             capabilities.append({
                 "type": "AlexaInterface",
                 "interface": "Alexa.CameraStreamController",
@@ -474,20 +1090,9 @@ class AmazonAlexa(YomboModule):
                 ]
                 })
 
-        elif device.PLATFORM == 'tv':
-            capabilities.append({
-                "type": "AlexaInterface",
-                "interface": "Alexa.ChannelController",
-                "version": "3",
-                "properties": {
-                    "supported": [
-                        {"name": "channel"}
-                    ],
-                    "proactivelyReported": False,
-                    "retrievable": False,
-                }
-            })
-            if 'channel_control' in device.FEATURES and device.FEATURES['channel_control'] == True:
+        elif platform == 'tv':
+            capabilities.append(controller_capability(_AlexaChannelController))
+            if 'channel_control' in features and features['channel_control'] == True:
                 capabilities.append({
                     "type": "AlexaInterface",
                     "interface": "Alexa.InputController",
@@ -500,7 +1105,7 @@ class AmazonAlexa(YomboModule):
                         "retrievable": False,
                     }
                 })
-                if 'input_control' in device.FEATURES and device.FEATURES['input_control'] == True:
+                if 'input_control' in features and features['input_control'] == True:
                     capabilities.append({
                     "type": "AlexaInterface",
                     "interface": "Alexa.Speaker",
@@ -515,51 +1120,17 @@ class AmazonAlexa(YomboModule):
                     }
                 })
 
-        elif device.PLATFORM == 'lock':
-            capabilities.append({
-                "type": "AlexaInterface",
-                "interface": "Alexa.LockController",
-                "version": "3",
-                "properties": {
-                    "supported": [
-                        {"name": "lockState"}
-                    ],
-                    "proactivelyReported": False,
-                    "retrievable": False,
-                }
-            })
+        elif platform == 'lock':
+            capabilities.append(controller_capability(_AlexaLockController))
 
 
         else:
-            for feature, value in device.FEATURES.items():
+            for feature, value in features.items():
                 if feature == FEATURE_POWER_CONTROL and value is True:
-                    capabilities.append({
-                        "type": "AlexaInterface",
-                        "interface": "Alexa.PowerController",
-                        "version": "3",
-                        "properties": {
-                            "supported": [
-                                {"name": "powerState"}
-                            ],
-                            "proactivelyReported": False,
-                            "retrievable": False,
-                        }
-                    })
+                    capabilities.append(controller_capability(_AlexaPowerController))
 
                 if feature == FEATURE_BRIGHTNESS and value is True:
-                    # endpoint['capabilites'].append({
-                    capabilities.append({
-                        "type": "AlexaInterface",
-                        "interface": "Alexa.BrightnessController",
-                        "version": "3",
-                        "properties": {
-                            "supported": [
-                                {"name": "brightness"}
-                            ],
-                            "proactivelyReported": False,
-                            "retrievable": False,
-                        }
-                    })
+                    capabilities.append(controller_capability(_AlexaBrightnessController))
                     capabilities.append({
                         "type": "AlexaInterface",
                         "interface": "Alexa.PowerLevelController",
@@ -598,23 +1169,13 @@ class AmazonAlexa(YomboModule):
                             "retrievable": False,
                         }
                     })
-                if (feature == FEATURE_RGB_COLOR and value is True) or (feature == FEATURE_XY_COLOR and value is True):
-                        capabilities.append({
-                        "type": "AlexaInterface",
-                        "interface": "Alexa.ColorController",
-                        "version": "3",
-                        "properties": {
-                            "supported": [
-                                {"name": "color"}
-                            ],
-                            "proactivelyReported": False,
-                            "retrievable": False,
-                        }
-                    })
+            # Once, even if the device has more than one of the color features.
+            if any(features.get(feature) is True for feature in (FEATURE_RGB_COLOR, FEATURE_XY_COLOR,
+                                                                 FEATURE_HS_COLOR)):
+                capabilities.append(controller_capability(_AlexaColorController))
 
         capabilities.append(endpoint_health())
-        endpoint['capabilities'] = capabilities
-        return endpoint
+        return tuple(capabilities)
 
     def generate_scene_endpoint(self, scene):
         """
@@ -638,34 +1199,7 @@ class AmazonAlexa(YomboModule):
                 "authkey": self.authkey.auth_id,
                 "uri": "https://e.%s:%s" % (self.fqdn, self.port)
             },
-            "capabilities": [
-                {
-                    "type": "AlexaInterface",
-                    "interface": "Alexa",
-                    "version": "3"
-                },
-                {
-                    "type": "AlexaInterface",
-                    "interface": "Alexa.SceneController",
-                    "version": "3",
-                    "supportsDeactivation": True,
-                    "proactivelyReported": False
-                },
-                {
-                    "type": "AlexaInterface",
-                    "interface": "Alexa.EndpointHealth",
-                    "version": "3",
-                    "properties": {
-                        "supported": [
-                            {
-                                "name": "connectivity"
-                            }
-                        ],
-                        "proactivelyReported": True,
-                        "retrievable": True
-                    }
-                }
-            ]
+            "capabilities": SCENE_CAPABILITIES,
         }
 
     @inlineCallbacks
@@ -677,34 +1211,140 @@ class AmazonAlexa(YomboModule):
         """
         pass
 
-    @inlineCallbacks
+    def get_api_responses(self, requests):
+        """
+        Processes a batch of directives concurrently. Each directive is isolated from the others, if one
+        fails, an ErrorResponse is returned in its place.
+
+        :param requests: List of directives.
+        :return: Deferred that fires with a list of responses, in the same order as the requests.
+        """
+        deferreds = [maybeDeferred(self.get_api_response, request) for request in requests]
+        d = DeferredList(deferreds, consumeErrors=True)
+        d.addCallback(self._collect_api_responses, requests)
+        return d
+
+    def _collect_api_responses(self, results, requests):
+        responses = []
+        for (success, result), request in zip(results, requests):
+            if success is False:
+                logger.warn("Error processing Alexa directive: {error}", error=result.getErrorMessage())
+                result = self.api_error_message(request, 'INTERNAL_ERROR', result.getErrorMessage())
+            responses.append(result)
+        return responses
+
     def get_api_response(self, request):
+        """
+        Handles a single directive. Synchronous handlers are called directly and their response is
+        returned as is, only handlers that return a Deferred cause a Deferred to be returned. Callers
+        that always need a Deferred should use maybeDeferred().
+
+        Alexa retries directives, retries have the same messageId and correlationToken. A retry of a
+        directive that was already handled gets the stored response, and a retry of a directive that
+        is still being handled waits for the original, the device isn't sent the command again.
+
+        Directives for devices, or gateways, that the circuit breakers consider unreachable get an
+        ENDPOINT_UNREACHABLE ErrorResponse right away. ReportState doesn't send a command, it's answered
+        from the state cache, which has the UNREACHABLE EndpointHealth. New directives must also be admitted
+        by the admission control, a half open breaker's probe is only used up once they are. Rejections and other ErrorResponses aren't stored, so Alexa's retry gets
+        another chance.
+
+        :param request: The directive.
+        :return: The response, or a Deferred that fires with it.
+        """
+        key = self.idempotency_cache.key(request)
+        if key is not None:
+            results = self.idempotency_cache.get(key)
+            if results is not None:
+                if self.debug_directives:
+                    logger.debug("Duplicate directive, reusing response: {key}", key=key)
+                return results
+
+        namespace = request['header']['namespace']
+        priority = DIRECTIVE_PRIORITIES.get(namespace, PRIORITY_NORMAL)
+        endpoint = request.get('endpoint')
+        breaker = None  # (device_id, gateway_id) if the directive goes through the circuit breakers.
+        if endpoint is not None and self.circuit_breakers.breakers and namespace != 'Alexa':
+            cookie = endpoint.get('cookie', {})
+            if cookie.get('endpoint_type') == 'device':
+                breaker = (endpoint['endpointId'], cookie.get('gwid'))
+                if self.circuit_breakers.allow(*breaker) is False:
+                    return self.api_error_message(request, 'ENDPOINT_UNREACHABLE', "Endpoint is unreachable.")
+
+        rejected = self.admission_control.check(request, priority)
+        if rejected is not None:
+            if self.debug_directives:
+                logger.debug("Directive rejected: {error}", error=rejected[1])
+            return self.api_error_message(request, rejected[0], rejected[1])
+        if breaker is not None:
+            self.circuit_breakers.probing(*breaker)
+
+        self.directive_priority = priority
+        results = self.dispatch_directive(request)
+        if key is not None:
+            self.idempotency_cache.add(key, results)
+        return results
+
+    def dispatch_directive(self, request):
+        """
+        Calls the handler for a directive, see get_api_response().
+        """
         namespace = request['header']['namespace']
         name = request['header']['name']
+        stats_key = "%s.%s" % (namespace, name)
+
+        started = perf_counter()
+        endpoint = request['endpoint']
+        resolved = self.resolved_endpoints.get(endpoint['endpointId'])
+        if resolved is None:
+            resolved = self.resolve_endpoint(endpoint['endpointId'], endpoint['cookie']['endpoint_type'])
+        self.directive_stats.record(stats_key, 'lookup', perf_counter() - started)
+
+        handler = resolved.handlers.get((namespace, name))
+        if handler is None:
+            if self.debug_directives:
+                logger.warn("Cannot find handler for: {namespace} - {name}", namespace=namespace, name=name)
+            return "failed..."
+
+        if self.debug_directives:
+            logger.debug("Found handler for: {namespace} - {name} = {handler}",
+                         namespace=namespace, name=name, handler=handler)
+        started = perf_counter()
+        self.stats_key = stats_key
+        try:
+            results = handler(request, resolved.item)
+        finally:
+            self.stats_key = None  # Later serializations, such as ChangeReports, aren't part of this directive.
+        if isinstance(results, Deferred):
+            results.addCallback(self.handler_finished, stats_key, started)
+            return results
+        self.directive_stats.record(stats_key, 'handler', perf_counter() - started)
+        return results
+
+    def handler_finished(self, results, stats_key, started):
+        self.directive_stats.record(stats_key, 'handler', perf_counter() - started)
+        return results
+
+    def resolve_endpoint(self, endpoint_id, endpoint_type):
+        """
+        Looks up the device or scene for an endpoint, along with its interface and handlers, and caches
+        the results for the next directive.
 
-        endpoint_type = request['endpoint']['cookie']['endpoint_type']
+        :param endpoint_id: The device_id or scene_id.
+        :param endpoint_type: Either 'device' or 'scene', from the endpoint cookie.
+        :return: _ResolvedEndpoint
+        """
         if endpoint_type == 'device':
-            item_id = request['endpoint']['endpointId']
-            # logger.info("getting device for: {item_id}", item_id=item_id)
-            yombo_device = self._Devices[item_id]
-        if endpoint_type == 'scene':
-            item_id = request['endpoint']['endpointId']
-            # logger.info("getting scene for: {item_id}", item_id=item_id)
-            yombo_device = self._Scenes[item_id]
-
-        if namespace in self.response_handlers:
-            if name in self.response_handlers[namespace]:
-                handler = self.response_handlers[namespace][name]
-                logger.info("Found handler for: {namespace} - {name} = {handler}", namespace=namespace, name=name, handler=handler)
-                d = Deferred()
-                # print("b : 55: %s" % handler)
-                d.addCallback(lambda ignored: maybeDeferred(handler, request, yombo_device))
-                d.callback(1)
-                results = yield d
-                # print("may be deferred results...%s" % json.dumps(results))
-                return results
-        # logger.warn("Cannot find handler for: {namespace} - {name}", namespace=namespace, name=name)
-        return "failed..."
+            item = self._Devices[endpoint_id]
+            interface = self.build_interface(item)
+        elif endpoint_type == 'scene':
+            item = self._Scenes[endpoint_id]
+            interface = None
+        else:
+            raise YomboWarning("Unknown Alexa endpoint type: %s" % endpoint_type)
+        resolved = _ResolvedEndpoint(endpoint_type, item, interface, self.handler_table)
+        self.resolved_endpoints[endpoint_id] = resolved
+        return resolved
 
     def api_message(self,
                     request,
@@ -715,36 +1355,30 @@ class AmazonAlexa(YomboModule):
         """
         Generate a response to Alexa API.
         """
-        payload = payload or {}
-
-        response = {
-            'alexaresponse': {
-                'event': {
-                    'header': {
-                        'namespace': namespace,
-                        'name': name,
-                        'messageId': str(uuid4()),
-                        'payloadVersion': '3',
-                    },
-                    'payload': payload,
-                }
-            },
-            'meta': {
-            }
-        }
-
-        # If a correlation token exists, add it to header / Need by Async requests
-        token = request['header'].get('correlationToken')
-        if token:
-            response['alexaresponse']['event']['header']['correlationToken'] = token
+        started = perf_counter()
+        response = self.responses.message(request, name=name, namespace=namespace, payload=payload,
+                                          context=context)
+        header = request['header']
+        if 'namespace' in header:
+            self.directive_stats.record("%s.%s" % (header['namespace'], header.get('name')), 'message',
+                                        perf_counter() - started)
+        return response
 
-        # Extend event with endpoint object / Need by Async requests
-        if 'endpoint' in request:
-            response['alexaresponse']['event']['endpoint'] = request['endpoint'].copy()
+    def api_error_message(self, request, error_type, message):
+        """
+        Generate an ErrorResponse to Alexa API.
 
-        if context is not None:
-            response['alexaresponse']['context'] = context
-        return response
+        :param request: The directive, it may be malformed.
+        :param error_type: Alexa error type, such as 'INTERNAL_ERROR' or 'ENDPOINT_UNREACHABLE'.
+        :param message: Human readable error message.
+        :return:
+        """
+        if isinstance(request, dict) is False or isinstance(request.get('header'), dict) is False:
+            request = {'header': {}}
+        return self.api_message(request,
+                                name='ErrorResponse',
+                                payload={'type': error_type, 'message': message},
+                                )
 
 ############################################
 ###  Start various api control responses ###
@@ -754,40 +1388,39 @@ class AmazonAlexa(YomboModule):
     def api_set_brightness(self, request, device):
         percent = request['payload']['brightness']
         # we call the set_percent method since alexa actually sends a percentage.
-        request_id = device.set_percent(percent,
-                                        auth=self.authkey,
-                                        )
+        failure = self.send_command(device, lambda: device.set_percent(percent, auth=self.authkey), coalesce='brightness')
+        if failure is not None:
+            return self.command_error_message(request, failure)
         context = self.find_interface(device).serialize_properties(values={'brightness': percent})
         return self.api_message(request, context=context)
 
     def api_scene_activate(self, request, scene):
         scene.start()
-        return _AlexaSceneController(scene, request, "ActivationStarted")
+        return _AlexaSceneController(scene, request, "ActivationStarted", self.responses)
 
     def api_scene_deactivate(self, request, scene):
         scene.stop()
-        return _AlexaSceneController(scene, request, "DeactivationStarted")
+        return _AlexaSceneController(scene, request, "DeactivationStarted", self.responses)
 
     # @inlineCallbacks
     def api_turn_on(self, request, device):
-        try:
-            device.turn_on(auth=self.authkey)
-        except Exception as e:
-            print("Error: %s" % e)
-            logger.error("{trace}", trace=traceback.format_exc())
-            raise e
-        controller = _AlexaPowerController(device)
-        context = self.find_interface(device).serialize_properties(
-            controllers=controller,
+        failure = self.send_command(device, lambda: device.turn_on(auth=self.authkey))
+        if failure is not None:
+            return self.command_error_message(request, failure)
+        interface = self.find_interface(device)
+        context = interface.serialize_properties(
+            controllers=interface.controller(_AlexaPowerController),
             values={'powerState': 'ON'})
         return self.api_message(request, context=context)
 
     # @inlineCallbacks
     def api_turn_off(self, request, device):
-        request_id = device.turn_off(auth=self.authkey)
-        controller = _AlexaPowerController(device)
-        context = self.find_interface(device).serialize_properties(
-            controllers=controller,
+        failure = self.send_command(device, lambda: device.turn_off(auth=self.authkey))
+        if failure is not None:
+            return self.command_error_message(request, failure)
+        interface = self.find_interface(device)
+        context = interface.serialize_properties(
+            controllers=interface.controller(_AlexaPowerController),
             values={'powerState': 'OFF'},)
         # print("After waiting 2 = %s" % context)
         return self.api_message(request, context=context)
@@ -799,15 +1432,17 @@ class AmazonAlexa(YomboModule):
         affiliate_call_sign = int(request['payload']['channel']['affiliateCallSign'])
         uri = int(request['payload']['channel']['uri'])
 
-        request_id = device.set_channel(channel_number, inputs={
+        failure = self.send_command(device, lambda: device.set_channel(channel_number, inputs={
             'call_sign': call_sign,
             'affiliate_call_sign': affiliate_call_sign.bit_length(),
             'uri': uri,
             }
-        )
-        controller = _AlexaChannelController(device)
-        context = self.find_interface(device).serialize_properties(
-            controllers=controller,
+        ))
+        if failure is not None:
+            return self.command_error_message(request, failure)
+        interface = self.find_interface(device)
+        context = interface.serialize_properties(
+            controllers=interface.controller(_AlexaChannelController),
             values={
                 'color': {
                     'number': request['payload']['color']['number'],
@@ -818,26 +1453,137 @@ class AmazonAlexa(YomboModule):
         )
         return self.api_message(request, context=context)
 
-    @inlineCallbacks
     def api_lock(self, request, device):
-        request_id = device.lock(auth=self.authkey)
-        yield self._Devices.wait_for_command_to_finish(request_id, timeout=5)
-        controller = _AlexaLockController(device)
-        context = self.find_interface(device).serialize_properties(
-            controllers=controller,
-            values={'lockState': 'LOCKED'},)
-        return self.api_message(request, context=context)
+        return self.api_deferred_response(request, device, lambda: device.lock(auth=self.authkey),
+                                          self.find_interface(device).controller(_AlexaLockController),
+                                          values={'lockState': 'LOCKED'})
 
-    @inlineCallbacks
     def api_unlock(self, request, device):
-        request_id = device.unlock(auth=self.authkey)
-        yield self._Devices.wait_for_command_to_finish(request_id, timeout=5)
-        controller = _AlexaLockController(device)
-        context = self.find_interface(device).serialize_properties(
-            controllers=controller,
-            values={'lockState': 'UNLOCKED'},)
-        # print("After waiting 2 = %s" % context)
-        return self.api_message(request, context=context)
+        return self.api_deferred_response(request, device, lambda: device.unlock(auth=self.authkey),
+                                          self.find_interface(device).controller(_AlexaLockController),
+                                          values={'lockState': 'UNLOCKED'})
+
+    def send_command(self, device, command, coalesce=None):
+        """
+        Send a device command through the command scheduler. Commands for a device are sent in order,
+        one at a time, commands for different devices are sent in parallel. The command gets the
+        priority of the directive being handled.
+
+        :param device: The device.
+        :param command: Callable that sends the command, returns the device command request_id.
+        :param coalesce: Property the command sets, such as 'brightness'. If given, a command for the same
+            property still waiting in the device's queue is replaced instead of sending both.
+        :return: The Failure if the command was sent right away and failed, otherwise None.
+        """
+        d = self.command_scheduler.submit(device, command, coalesce=coalesce, priority=self.directive_priority)
+        failure = self.command_failed_now(d)
+        d.addErrback(self.send_command_failed, device)
+        return failure
+
+    @staticmethod
+    def command_failed_now(d):
+        """
+        Return the Failure of a scheduler Deferred that has already failed, such as when the queue was
+        empty and the command raised. Returns None if it hasn't failed yet.
+        """
+        failures = []
+
+        def check(result):
+            if isinstance(result, Failure):
+                failures.append(result)
+            return result
+        d.addBoth(check)
+        return failures[0] if failures else None
+
+    def command_error_message(self, request, failure):
+        """
+        ErrorResponse for a device command that failed right away.
+        """
+        if failure.check(_EndpointUnreachable):
+            return self.api_error_message(request, 'ENDPOINT_UNREACHABLE', failure.getErrorMessage())
+        return self.api_error_message(request, 'INTERNAL_ERROR', failure.getErrorMessage())
+
+    def send_command_failed(self, failure, device):
+        logger.warn("Device command for {label} failed: {error}", label=device.full_label,
+                    error=failure.getErrorMessage())
+
+    def api_deferred_response(self, request, device, command, controller, values):
+        """
+        Responds right away with a DeferredResponse for slow commands, such as locks. Once the command
+        finishes, the final Response, or an ErrorResponse, is sent to Alexa through the event sender.
+
+        The estimated deferral is based on how long the device usually takes, and how many commands
+        are ahead of this one.
+
+        :param request: The directive.
+        :param device: The device the command is for.
+        :param command: Callable that sends the command, see send_command().
+        :param controller: Controller used to serialize the final properties.
+        :param values: Property values to report once the command finishes.
+        :return: DeferredResponse message
+        """
+        scheduler = self.command_scheduler
+        commands = scheduler.ahead(device.device_id) + 1
+        timeout = scheduler.latencies.timeout(device.device_id)
+        expected = scheduler.latencies.expected(device.device_id)
+        if expected is None:
+            expected = timeout
+        d = self.command_scheduler.submit(device, command, priority=self.directive_priority)
+        failure = self.command_failed_now(d)
+        if failure is not None:
+            d.addErrback(self.send_command_failed, device)
+            return self.command_error_message(request, failure)
+
+        pending_id = self.responses.message_id()
+        self.pending_commands[pending_id] = {
+            'request': request,
+            'device_id': device.device_id,
+            'expires': time() + timeout * commands + 30,
+        }
+        d.addCallbacks(self.deferred_command_finished, self.deferred_command_failed,
+                       callbackArgs=(pending_id, device, controller, values),
+                       errbackArgs=(pending_id,))
+        return self.api_message(request,
+                                name='DeferredResponse',
+                                payload={'estimatedDeferralInSeconds': max(1, int(ceil(expected * commands)))})
+
+    def deferred_command_finished(self, result, pending_id, device, controller, values):
+        pending = self.pending_commands.pop(pending_id, None)
+        if pending is None:  # Already expired.
+            return
+        context = self.find_interface(device).serialize_properties(controllers=controller, values=values)
+        self.send_deferred_event(self.api_message(pending['request'], context=context))
+
+    def deferred_command_failed(self, failure, pending_id):
+        pending = self.pending_commands.pop(pending_id, None)
+        if pending is None:
+            return
+        self.send_deferred_event(self.api_error_message(pending['request'],
+                                                        'ENDPOINT_UNREACHABLE',
+                                                        failure.getErrorMessage()))
+
+    def send_deferred_event(self, event):
+        """
+        Send the final event for a DeferredResponse. Always sent on the next reactor turn so the
+        DeferredResponse itself is returned first.
+        """
+        def send():
+            d = maybeDeferred(self.event_sender, [event])
+            d.addErrback(lambda failure: logger.warn("Unable to send Alexa deferred response: {error}",
+                                                     error=failure.getErrorMessage()))
+        reactor.callLater(0, send)
+
+    def expire_pending_commands(self):
+        """
+        Safety net for commands that never finished or failed, Alexa gets an ErrorResponse for them.
+        """
+        now = time()
+        for pending_id in [pending_id for pending_id, pending in self.pending_commands.items()
+                           if pending['expires'] < now]:
+            pending = self.pending_commands.pop(pending_id)
+            self.send_deferred_event(self.api_error_message(pending['request'],
+                                                            'ENDPOINT_UNREACHABLE',
+                                                            'Device command never completed.'))
 
     # @inlineCallbacks
     def api_set_color(self, request, device):
@@ -846,10 +1592,12 @@ class AmazonAlexa(YomboModule):
             float(request['payload']['color']['saturation']),
             float(request['payload']['color']['brightness'])
         )
-        request_id = device.set_color(rgb, auth=self.authkey)
-        controller = _AlexaColorController(device)
-        context = self.find_interface(device).serialize_properties(
-            controllers=controller,
+        failure = self.send_command(device, lambda: device.set_color(rgb, auth=self.authkey), coalesce='color')
+        if failure is not None:
+            return self.command_error_message(request, failure)
+        interface = self.find_interface(device)
+        context = interface.serialize_properties(
+            controllers=interface.controller(_AlexaColorController),
             values={
                 'color': {
                     'hue': request['payload']['color']['hue'],
@@ -861,11 +1609,92 @@ class AmazonAlexa(YomboModule):
         # print("alexa context: %s" % context)
         return self.api_message(request, context=context)
 
-    @inlineCallbacks
+    def api_report_state(self, request, item):
+        """
+        Responds to ReportState from the state cache, the device isn't asked for anything unless this
+        endpoint hasn't been cached yet.
+        """
+        endpoint_id = request['endpoint']['endpointId']
+        context = self.state_cache.get(endpoint_id)
+        if context is None:
+            context = self.update_state_cache(endpoint_id, item)
+        return self.api_message(request, name='StateReport', context=context)
+
+    def change_report_event(self, endpoint_id, changed, context):
+        """
+        Generate a ChangeReport event for an endpoint.
+
+        :param endpoint_id: The device_id or scene_id.
+        :param changed: List of properties that changed.
+        :param context: List of properties that didn't change.
+        :return:
+        """
+        return self.api_message({'header': {}, 'endpoint': {'endpointId': endpoint_id}},
+                                name='ChangeReport',
+                                payload={
+                                    'change': {
+                                        'cause': {'type': 'PHYSICAL_INTERACTION'},
+                                        'properties': changed,
+                                    }
+                                },
+                                context={'properties': context},
+                                )
+
+    def update_state_cache(self, endpoint_id, item, time_of_sample=None):
+        """
+        Samples the current properties of a device or scene and stores them in the state cache.
+
+        :param endpoint_id: The device_id or scene_id.
+        :param item: The device or scene.
+        :param time_of_sample: Epoch time of the sample, defaults to now.
+        :return: The cached context.
+        """
+        if time_of_sample is None:
+            time_of_sample = time()
+        interface = self.find_interface(item) if hasattr(item, 'PLATFORM') else None
+        if interface is None:
+            time_of_sample = self.responses.timestamp(time_of_sample)
+            context = {'properties': [self.responses.endpoint_health(time_of_sample)]}
+        else:
+            context = interface.serialize_properties(time_of_sample=time_of_sample)
+        self.state_cache.set(endpoint_id, context)
+        return context
+
+    def connectivity_changed(self, device_ids=None, gateway_id=None):
+        """
+        Called by the circuit breakers when devices become reachable or unreachable. Refreshes the state
+        cache and sends ChangeReports, so Alexa sees the new EndpointHealth.
+
+        :param device_ids: List of device_ids that changed.
+        :param gateway_id: Or, every device of this gateway changed.
+        """
+        if self.allowed_devices is None:
+            return
+        if gateway_id is not None:
+            device_ids = [device_id for device_id in self.allowed_devices if device_id in self._Devices and
+                          self._Devices[device_id].gateway_id == gateway_id]
+        for device_id in device_ids:
+            if device_id not in self.allowed_devices or device_id not in self._Devices:
+                continue
+            context = self.update_state_cache(device_id, self._Devices[device_id])
+            if self.change_reporter is not None:
+                self.change_reporter.report(device_id, context)
+
     def api_undefined(self, request, device):
         return "failed..."
 
     def find_interface(self, device):
+        """
+        Returns the interface for a device. Interfaces, and their controllers, are kept in the resolved
+        endpoint cache so they are only built once per device.
+        """
+        resolved = self.resolved_endpoints.get(device.device_id)
+        if resolved is None or resolved.item is not device:
+            resolved = _ResolvedEndpoint('device', device, self.build_interface(device), self.handler_table)
+            self.resolved_endpoints[device.device_id] = resolved
+        return resolved.interface
+
+    def build_interface(self, device):
         # print("find_interface type: %s" % device)
         # print("find_interface type: %s" % device.PLATFORM)
         if device.PLATFORM in (PLATFORM_SWITCH, PLATFORM_APPLIANCE):
@@ -878,6 +1707,1025 @@ class AmazonAlexa(YomboModule):
         if device.PLATFORM in (PLATFORM_TV):
             return _ChannelInterface(self, device)
 
+
+class _ResolvedEndpoint(object):
+    """
+    Everything needed to handle a directive for an endpoint: the device or scene, its interface,
+    controllers and the handler table.
+    """
+    __slots__ = ('endpoint_type', 'item', 'interface', 'controllers', 'handlers')
+
+    def __init__(self, endpoint_type, item, interface, handlers):
+        self.endpoint_type = endpoint_type
+        self.item = item
+        self.interface = interface
+        self.controllers = interface.controllers() if interface is not None else ()
+        self.handlers = handlers
+
+
+class _LRUCache(object):
+    """
+    A small least recently used cache.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return default
+        return self.items[key]
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class _IdempotencyCache(object):
+    """
+    Responses of recently handled directives, keyed by messageId and correlationToken. Entries expire
+    after ttl seconds, and the oldest are dropped once there are more than maxsize.
+
+    Directives still being handled store their Deferred. Duplicates get a new Deferred that fires
+    with the original's results. Failures and ErrorResponses aren't stored, so the next retry runs again.
+    """
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> [expires, response, waiters], waiters is None once finished.
+        self.hits = 0
+
+    @staticmethod
+    def key(request):
+        """
+        Return the cache key of a directive, or None if it doesn't have a messageId.
+        """
+        header = request['header']
+        message_id = header.get('messageId')
+        if not message_id:
+            return None
+        return message_id, header.get('correlationToken')
+
+    def get(self, key):
+        """
+        Return the stored response, or a Deferred if the directive is still being handled. Returns None
+        for unknown or expired keys.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time():
+            del self.entries[key]
+            return None
+        self.hits += 1
+        if entry[2] is None:
+            return entry[1]
+        d = Deferred()
+        entry[2].append(d)
+        return d
+
+    def add(self, key, response):
+        """
+        Store the response of a directive, which may be a Deferred.
+
+        :return: The response.
+        """
+        if isinstance(response, Deferred):
+            entry = [time() + self.ttl, None, []]
+            response.addCallbacks(self.finished, self.failed,
+                                  callbackArgs=(key, entry), errbackArgs=(key, entry))
+        elif self.is_error(response):
+            return response
+        else:
+            entry = [time() + self.ttl, response, None]
+        self.entries[key] = entry
+        self.expire()
+        return response
+
+    def finished(self, response, key, entry):
+        if self.is_error(response) and self.entries.get(key) is entry:
+            del self.entries[key]
+        waiters = entry[2]
+        entry[1] = response
+        entry[2] = None
+        for d in waiters:
+            d.callback(response)
+        return response
+
+    @staticmethod
+    def is_error(response):
+        """
+        Return True if the response is an Alexa ErrorResponse.
+        """
+        try:
+            return response['alexaresponse']['event']['header']['name'] == 'ErrorResponse'
+        except (KeyError, TypeError):
+            return False
+
+    def failed(self, failure, key, entry):
+        if self.entries.get(key) is entry:
+            del self.entries[key]
+        waiters = entry[2]
+        entry[2] = None
+        for d in waiters:
+            d.errback(failure)
+        return failure
+
+    def expire(self):
+        """
+        Drop expired entries and the oldest entries over maxsize. Every entry has the same ttl, so the
+        oldest entries are always the first to expire.
+        """
+        now = time()
+        entries = self.entries
+        while entries:
+            expires = next(iter(entries.values()))[0]
+            if len(entries) <= self.maxsize and expires >= now:
+                break
+            entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class _StateCache(object):
+    """
+    Last known Alexa context (properties) for each endpoint, fed from device status events.
+    """
+    def __init__(self):
+        self.endpoints = {}
+
+    def get(self, endpoint_id):
+        return self.endpoints.get(endpoint_id)
+
+    def set(self, endpoint_id, context):
+        self.endpoints[endpoint_id] = context
+
+    def remove(self, endpoint_id):
+        self.endpoints.pop(endpoint_id, None)
+
+    def clear(self):
+        self.endpoints.clear()
+
+    def __contains__(self, endpoint_id):
+        return endpoint_id in self.endpoints
+
+    def __len__(self):
+        return len(self.endpoints)
+
+
+class _CommandScheduler(object):
+    """
+    Sits between the api_* handlers and the device command methods. Each device has its own queue and
+    only one command is sent to a device at a time, the next is sent once the previous finishes or
+    fails. Devices take turns, with at most max_in_flight commands in flight across all devices.
+
+    Commands submitted with a coalesce name are last write wins, such as dragging the brightness
+    slider in the Alexa app. If the last queued command is for the same property it's replaced, so a
+    stream of them has at most one command in flight and one pending. Commands are never reordered.
+
+    Ready devices wait in one queue per priority, the device's next command decides which. The queues
+    are bounded by max_queued and max_device_depth, see is_full().
+
+    How long each device takes to finish commands is tracked in latencies, which also sets the
+    timeout for each command.
+    """
+    def __init__(self, parent, max_in_flight=20, max_queued=500, max_device_depth=10):
+        self.parent = parent
+        self.max_in_flight = max_in_flight
+        self.latencies = DeviceLatencies()
+        self.max_queued = max_queued
+        self.max_device_depth = max_device_depth
+        self.queues = {}  # device_id -> deque of [coalesce, command, waiters, priority, device]
+        # device_ids with queued commands waiting for an in flight slot, one deque per priority.
+        self.ready = tuple(deque() for priority in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW))
+        self.active = set()  # device_ids either ready or in flight.
+        self.in_flight = 0
+        self.pumping = False
+        self.queued = 0
+        self.peak_queued = 0
+        self.sent = 0
+        self.coalesced = 0
+
+    def is_full(self, device_id):
+        """
+        Return True if no more commands should be queued, in total or for the device.
+        """
+        if self.queued >= self.max_queued:
+            return True
+        queue = self.queues.get(device_id)
+        return queue is not None and len(queue) >= self.max_device_depth
+
+    def ahead(self, device_id):
+        """
+        Return about how many commands a new command for the device would wait for.
+        """
+        if device_id not in self.active:
+            return 0
+        return len(self.queues[device_id]) + 1
+
+    def submit(self, device, command, coalesce=None, priority=PRIORITY_NORMAL):
+        """
+        Queue a command for a device. The queue bounds aren't enforced here, directives are rejected
+        before they get this far by _AdmissionControl.
+
+        :param device: The device.
+        :param command: Callable that sends the command, returns the device command request_id.
+        :param coalesce: Property name for last write wins, or None to always send the command.
+        :param priority: One of the PRIORITY_* classes.
+        :return: Deferred that fires with the request_id once the command finishes.
+        """
+        d = Deferred()
+        device_id = device.device_id
+        queue = self.queues.get(device_id)
+        if queue is None:
+            queue = self.queues[device_id] = deque()
+        elif coalesce is not None and queue and queue[-1][0] == coalesce:
+            # Only the last queued command is replaced, replacing an earlier one would move this command
+            # ahead of the commands queued after it.
+            entry = queue[-1]
+            entry[1] = command
+            entry[2].append(d)
+            self.coalesced += 1
+            return d
+
+        queue.append([coalesce, command, [d], priority, device])
+        self.queued += 1
+        if self.queued > self.peak_queued:
+            self.peak_queued = self.queued
+        if device_id not in self.active:
+            self.active.add(device_id)
+            self.ready[priority].append(device_id)
+            self.pump()
+        return d
+
+    def pump(self):
+        """
+        Send commands for ready devices while there's room. Commands that finish right away call back
+        into pump(), those calls return and leave the work to the outer loop.
+        """
+        if self.pumping:
+            return
+        self.pumping = True
+        try:
+            while self.in_flight < self.max_in_flight:
+                for ready in self.ready:
+                    if ready:
+                        self.send(ready.popleft())
+                        break
+                else:
+                    break
+        finally:
+            self.pumping = False
+
+    def send(self, device_id):
+        entry = self.queues[device_id].popleft()
+        self.queued -= 1
+        self.in_flight += 1
+        if self.parent.circuit_breakers.is_open(device_id, entry[4].gateway_id):
+            self.finished(Failure(_EndpointUnreachable("Endpoint is unreachable.")), device_id, entry,
+                          tripped=True)
+            return
+        self.sent += 1
+        try:
+            request_id = entry[1]()
+        except Exception:
+            self.finished(Failure(), device_id, entry)
+            return
+        if request_id is None:
+            self.finished(None, device_id, entry)
+            return
+        timeout = self.latencies.timeout(device_id)
+        started = perf_counter()
+        # maybeDeferred, so an error raised right away still goes through finished() and frees the slot.
+        d = maybeDeferred(self.parent._Devices.wait_for_command_to_finish, request_id, timeout=timeout)
+        d.addBoth(self.finished, device_id, entry, started, timeout)
+
+    def finished(self, result, device_id, entry, started=None, timeout=None, tripped=False):
+        failed = isinstance(result, Failure)
+        if started is not None:
+            elapsed = perf_counter() - started
+            # Timeouts are recorded too, so a device slower than its timeout gets a longer one next time.
+            if failed is False or elapsed >= timeout:
+                self.latencies.record(device_id, entry[4].full_label, elapsed)
+        if tripped is False:
+            if failed:
+                self.parent.circuit_breakers.failure(device_id, entry[4].gateway_id)
+            else:
+                self.parent.circuit_breakers.success(device_id, entry[4].gateway_id)
+        self.in_flight -= 1
+        queue = self.queues[device_id]
+        if queue:
+            self.ready[queue[0][3]].append(device_id)
+        else:
+            del self.queues[device_id]
+            self.active.discard(device_id)
+        for d in entry[2]:
+            if failed:
+                d.errback(result)
+            else:
+                d.callback(result)
+        self.pump()
+
+    def depths(self):
+        """
+        Return the queue depth of each device with queued commands.
+        """
+        return {device_id: len(queue) for device_id, queue in self.queues.items() if queue}
+
+    def stats(self):
+        """
+        Return the scheduler metrics.
+        """
+        depths = self.depths()
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queued': self.queued,
+            'peak_queued': self.peak_queued,
+            'max_device_depth': max(depths.values()) if depths else 0,
+            'devices_waiting': sum(len(ready) for ready in self.ready),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+        }
+
+
+class _CircuitBreakers(object):
+    """
+    Circuit breakers for each device and each gateway, so directives for unreachable devices fail
+    right away instead of waiting out command timeouts.
+
+    A breaker opens after failure_threshold failed or timed out commands in a row for a device, or
+    gateway_failure_threshold for all the devices of a gateway. While open, directives are rejected.
+    After reset_timeout seconds the breaker is half open, and the next directive is let through as a
+    probe. The probe's command closes the breaker if it works, or opens it again if not.
+
+    Only breakers that aren't closed, or have failures, are kept.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, parent, failure_threshold=3, gateway_failure_threshold=10, reset_timeout=30):
+        self.parent = parent
+        self.failure_threshold = failure_threshold
+        self.gateway_failure_threshold = gateway_failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}  # ('device'|'gateway', id) -> [state, failures, changed, probing]
+
+    def keys(self, device_id, gateway_id):
+        if gateway_id is None:
+            return (('device', device_id),)
+        return ('device', device_id), ('gateway', gateway_id)
+
+    def allow(self, device_id, gateway_id):
+        """
+        Check if a directive for a device should be handled. Half open breakers let one probe through
+        every reset_timeout seconds. This doesn't use up the probe, call probing() once the directive
+        is going to be handled.
+
+        :param device_id: The device.
+        :param gateway_id: The gateway of the device, from the endpoint cookie.
+        :return: True if allowed.
+        """
+        now = time()
+        for key in self.keys(device_id, gateway_id):
+            breaker = self.breakers.get(key)
+            if breaker is None or breaker[0] == self.CLOSED:
+                continue
+            if breaker[0] == self.OPEN:
+                if now - breaker[2] < self.reset_timeout:
+                    return False
+            elif breaker[3] is not None and now - breaker[3] < self.reset_timeout:
+                return False
+        return True
+
+    def probing(self, device_id, gateway_id):
+        """
+        A directive allowed by allow() is being handled, it's the probe of breakers that aren't closed.
+        """
+        now = time()
+        for key in self.keys(device_id, gateway_id):
+            breaker = self.breakers.get(key)
+            if breaker is None or breaker[0] == self.CLOSED:
+                continue
+            if breaker[0] == self.OPEN:
+                breaker[0] = self.HALF_OPEN
+                breaker[2] = now
+            breaker[3] = now
+
+    def is_open(self, device_id, gateway_id):
+        """
+        Return True if the device or its gateway is open, commands for it shouldn't be sent.
+        """
+        if not self.breakers:
+            return False
+        for key in self.keys(device_id, gateway_id):
+            breaker = self.breakers.get(key)
+            if breaker is not None and breaker[0] == self.OPEN:
+                return True
+        return False
+
+    def connectivity(self, device_id, gateway_id):
+        """
+        Return the Alexa.EndpointHealth connectivity value for a device.
+        """
+        if not self.breakers:
+            return 'OK'
+        for key in self.keys(device_id, gateway_id):
+            breaker = self.breakers.get(key)
+            if breaker is not None and breaker[0] != self.CLOSED:
+                return 'UNREACHABLE'
+        return 'OK'
+
+    def success(self, device_id, gateway_id):
+        """
+        Record a command that finished, closes the breakers of the device and its gateway.
+        """
+        if not self.breakers:
+            return
+        for key in self.keys(device_id, gateway_id):
+            breaker = self.breakers.pop(key, None)
+            if breaker is not None and breaker[0] != self.CLOSED:
+                logger.info("Alexa endpoint reachable again: {key}", key=key)
+                self.changed(key)
+
+    def failure(self, device_id, gateway_id):
+        """
+        Record a command that failed or timed out.
+        """
+        now = time()
+        for key in self.keys(device_id, gateway_id):
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = self.breakers[key] = [self.CLOSED, 0, now, None]
+            breaker[1] += 1
+            threshold = self.failure_threshold if key[0] == 'device' else self.gateway_failure_threshold
+            if breaker[0] == self.HALF_OPEN or (breaker[0] == self.CLOSED and breaker[1] >= threshold):
+                was_closed = breaker[0] == self.CLOSED
+                breaker[0] = self.OPEN
+                breaker[2] = now
+                breaker[3] = None
+                if was_closed:
+                    logger.warn("Alexa endpoint unreachable, failing fast: {key}", key=key)
+                    self.changed(key)
+
+    def changed(self, key):
+        if key[0] == 'device':
+            self.parent.connectivity_changed(device_ids=[key[1]])
+        else:
+            self.parent.connectivity_changed(gateway_id=key[1])
+
+    def summary(self):
+        """
+        Return the breakers that aren't closed, as a dict of 'device:id' or 'gateway:id' -> state.
+        """
+        return {"%s:%s" % key: breaker[0] for key, breaker in self.breakers.items() if breaker[0] != self.CLOSED}
+
+
+class _TokenBucket(object):
+    """
+    Allows rate requests a second on average, with bursts of up to burst requests.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now, reserve=0):
+        """
+        Take a token if more than reserve tokens would be left.
+
+        :return: True if a token was taken.
+        """
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens - 1 < reserve:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+    def refund(self):
+        """
+        Give back a token taken for a request that was rejected for another reason.
+        """
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class _AdmissionControl(object):
+    """
+    Decides if a directive is handled or rejected right away, so bursts are shed predictably instead
+    of every directive timing out.
+
+    - A global token bucket, lower priority directives must leave a reserve of tokens for higher
+      priority ones, so ReportState polls are rejected first and locks and scenes last.
+    - A token bucket for each endpoint, the least recently used are dropped past max_endpoints.
+      Directives in COALESCED_DIRECTIVES are exempt, the command scheduler coalesces them instead.
+    - Device commands are rejected when the command scheduler's queues are full.
+    """
+    # Share of the global burst each priority class must leave for higher priorities.
+    RESERVES = {PRIORITY_HIGH: 0.0, PRIORITY_NORMAL: 0.1, PRIORITY_LOW: 0.25}
+
+    def __init__(self, scheduler, rate=50, burst=100, endpoint_rate=5, endpoint_burst=10, max_endpoints=4096):
+        self.scheduler = scheduler
+        self.max_endpoints = max_endpoints
+        self.endpoints = OrderedDict()  # endpoint_id -> _TokenBucket
+        self.rejected = {'ENDPOINT_BUSY': 0, 'RATE_LIMIT_EXCEEDED': 0}
+        self.configure(rate, burst, endpoint_rate, endpoint_burst)
+
+    def configure(self, rate, burst, endpoint_rate, endpoint_burst):
+        self.endpoint_rate = endpoint_rate
+        self.endpoint_burst = endpoint_burst
+        self.bucket = _TokenBucket(rate, burst, time())
+        self.reserves = {priority: share * burst for priority, share in self.RESERVES.items()}
+        self.endpoints.clear()
+
+    def check(self, request, priority):
+        """
+        Check if a directive can be handled.
+
+        :param request: The directive.
+        :param priority: One of the PRIORITY_* classes.
+        :return: None if admitted, otherwise a tuple of the Alexa error type and message.
+        """
+        now = time()
+        endpoint_id = request.get('endpoint', {}).get('endpointId')
+        if priority != PRIORITY_LOW and endpoint_id is not None and self.scheduler.is_full(endpoint_id):
+            return self.reject('ENDPOINT_BUSY', "Too many commands waiting for this endpoint.")
+        # The endpoint's bucket is checked first, so a noisy endpoint can't drain the global bucket with
+        # directives that would be rejected anyway.
+        bucket = None
+        header = request['header']
+        if endpoint_id is not None and (header['namespace'], header.get('name')) not in COALESCED_DIRECTIVES:
+            bucket = self.endpoints.get(endpoint_id)
+            if bucket is None:
+                bucket = self.endpoints[endpoint_id] = _TokenBucket(self.endpoint_rate, self.endpoint_burst, now)
+                if len(self.endpoints) > self.max_endpoints:
+                    self.endpoints.popitem(last=False)
+            else:
+                self.endpoints.move_to_end(endpoint_id)
+            if bucket.take(now) is False:
+                return self.reject('RATE_LIMIT_EXCEEDED', "Too many directives for this endpoint.")
+        if self.bucket.take(now, self.reserves[priority]) is False:
+            if bucket is not None:
+                bucket.refund()
+            return self.reject('RATE_LIMIT_EXCEEDED', "Too many directives, try again shortly.")
+        return None
+
+    def reject(self, error_type, message):
+        self.rejected[error_type] += 1
+        return error_type, message
+
+
+class _ChangeReporter(object):
+    """
+    Collects endpoint state changes and sends them to Alexa as ChangeReport events. Changes for an
+    endpoint are coalesced within the window, only the difference between the last reported state and
+    the latest state is sent. All endpoints changed within the window are sent as a single batch.
+    """
+    def __init__(self, parent, window=2, max_batch=50):
+        """
+        :param parent: The AmazonAlexa module, provides change_report_event() and event_sender.
+        :param window: Seconds to collect changes before sending.
+        :param max_batch: Send right away once this many endpoints have changes waiting.
+        """
+        self.parent = parent
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = OrderedDict()  # endpoint_id -> latest context
+        self.reported = {}  # endpoint_id -> {(namespace, name): value} last sent to Alexa
+        self.timer = None
+
+    def report(self, endpoint_id, context):
+        """
+        Queue the latest state of an endpoint to be reported.
+
+        :param endpoint_id: The device_id or scene_id.
+        :param context: Context, as generated by serialize_properties().
+        """
+        self.pending[endpoint_id] = context
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = reactor.callLater(self.window, self.flush)
+
+    def flush(self):
+        """
+        Send all pending changes now.
+
+        :return: Deferred from the sender, or None if nothing was sent.
+        """
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+        if len(self.pending) == 0:
+            return
+
+        pending = self.pending
+        self.pending = OrderedDict()
+        events = []
+        for endpoint_id, context in pending.items():
+            previous = self.reported.get(endpoint_id, {})
+            changed = []
+            unchanged = []
+            current = {}
+            for item in context['properties']:
+                if item['namespace'] not in REPORTED_NAMESPACES:  # Not proactivelyReported in discovery.
+                    continue
+                key = (item['namespace'], item['name'])
+                current[key] = item['value']
+                if key in previous and previous[key] == item['value']:
+                    unchanged.append(item)
+                else:
+                    changed.append(item)
+            self.reported[endpoint_id] = current
+            if len(changed):
+                events.append(self.parent.change_report_event(endpoint_id, changed, unchanged))
+
+        if len(events) == 0:
+            return
+        d = maybeDeferred(self.parent.event_sender, events)
+        d.addErrback(self.send_failed, len(events))
+        return d
+
+    @staticmethod
+    def send_failed(failure, count):
+        logger.warn("Unable to send {count} Alexa change reports: {error}",
+                    count=count, error=failure.getErrorMessage())
+
+    def forget(self, endpoint_id):
+        """
+        Drop everything known about an endpoint, such as when it's removed from Alexa.
+        """
+        self.pending.pop(endpoint_id, None)
+        self.reported.pop(endpoint_id, None)
+
+
+class _NodePersister(object):
+    """
+    Write-behind saving of the module node. Changes mark a subtree of the node as dirty, saves are
+    delayed by the debounce window so bursts of changes result in a single save, and saves never
+    happen more often than min_interval. Call flush() to save right away, such as when stopping.
+
+    Subtrees with a sync handler are synced by calling the handler instead of saving the entire node.
+    If the sync fails, the entire node is saved instead. Only subtrees whose save failed are marked
+    dirty again.
+    """
+    SUBTREES = ('devices', 'scenes', 'alexa', 'configs')
+
+    def __init__(self, node, debounce=5, min_interval=30, sync_handlers=None):
+        """
+        :param node: The node to save.
+        :param debounce: Seconds to wait for more changes before saving.
+        :param min_interval: Minimum seconds between saves.
+        :param sync_handlers: Dictionary of subtree -> callable, used instead of saving the node.
+        """
+        self.node = node
+        self.sync_handlers = sync_handlers or {}
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.dirty = set()
+        self.last_save = 0
+        self.saving = None  # Deferred of the save in progress.
+        self.timer = None
+        self.save_count = 0
+
+    def mark_dirty(self, *subtrees):
+        """
+        Mark parts of the node as changed, and schedule a save.
+
+        :param subtrees: One or more of SUBTREES.
+        """
+        for subtree in subtrees:
+            if subtree not in self.SUBTREES:
+                raise YomboWarning("Unknown Alexa node subtree: %s" % subtree)
+        self.dirty.update(subtrees)
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is not None or self.saving is not None or len(self.dirty) == 0:
+            return
+        delay = max(self.debounce, self.last_save + self.min_interval - time())
+        self.timer = reactor.callLater(delay, self.flush)
+
+    def flush(self, full=False):
+        """
+        Save now if anything is dirty.
+
+        :param full: If True, save the entire node even for subtrees that have a sync handler.
+        :return: Deferred that fires once saved.
+        """
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+        if self.saving is not None:  # Save again once the current save finishes.
+            d = Deferred()
+
+            def save_again(result):
+                self.flush(full).chainDeferred(d)
+                return result
+            self.saving.addBoth(save_again)
+            return d
+        if len(self.dirty) == 0:
+            return succeed(None)
+
+        dirty = self.dirty
+        self.dirty = set()
+        self.last_save = time()
+        handled = set() if full else dirty & set(self.sync_handlers)
+        saves = []
+        subtrees = []  # Subtrees covered by each of saves.
+        for subtree in handled:
+            saves.append(maybeDeferred(self.sync_handlers[subtree]).addErrback(self.sync_failed, subtree))
+            subtrees.append({subtree})
+        if len(dirty - handled):
+            self.save_count += 1
+            saves.append(maybeDeferred(self.node.save))
+            subtrees.append(dirty - handled)
+        d = DeferredList(saves, consumeErrors=True)
+        self.saving = d
+        d.addCallback(self.saved, subtrees)
+        return d
+
+    def sync_failed(self, failure, subtree):
+        logger.warn("Unable to sync Alexa node {subtree}, saving the entire node instead: {error}",
+                    subtree=subtree, error=failure.getErrorMessage())
+        self.save_count += 1
+        return maybeDeferred(self.node.save)
+
+    def saved(self, results, subtrees):
+        self.saving = None
+        for (success, result), saved in zip(results, subtrees):
+            if success is False:
+                logger.warn("Unable to save Alexa node: {error}", error=result.getErrorMessage())
+                self.dirty.update(saved)
+        self.schedule()
+        return results
+
+
+class _EndpointSync(object):
+    """
+    Syncs the 'alexa' endpoints to Yombo as deltas instead of uploading the entire document.
+
+    Each endpoint has a content hash and the document version it last changed in. Patches contain
+    only the endpoints that changed or were removed since the last version Yombo acknowledged. If
+    Yombo's version doesn't match, or nothing has been acknowledged yet, the entire document is sent.
+
+    Discovery only records which endpoints changed, they are hashed when the next sync is sent. This
+    keeps the hashing out of discovery's time slices, and endpoints that change again before the sync
+    are only hashed once.
+    """
+    def __init__(self, parent):
+        """
+        :param parent: The AmazonAlexa module, provides the endpoints and endpoint_sync_sender.
+        """
+        self.parent = parent
+        self.version = 0
+        self.hashes = {}  # endpoint_id -> content hash
+        self.versions = {}  # endpoint_id -> version the endpoint last changed in
+        self.acked_version = None  # None until Yombo acknowledges a full upload.
+        self.acked_hashes = {}  # endpoint_id -> content hash Yombo has
+        self.unacked = set()  # endpoint ids changed since the acknowledged version.
+        self.pending = set()  # endpoint ids added or changed by discovery, not hashed yet.
+        self.sending = None
+
+    @staticmethod
+    def content_hash(endpoint):
+        return sha1(json.dumps(endpoint, sort_keys=True).encode()).hexdigest()
+
+    def record(self, delta):
+        """
+        Record the changes from a discovery run. Added and changed endpoints are hashed by the next sync().
+
+        :param delta: Dictionary of added, changed and removed endpoint id lists.
+        """
+        self.pending.update(delta['added'])
+        self.pending.update(delta['changed'])
+        changed = False
+        for endpoint_id in delta['removed']:
+            self.pending.discard(endpoint_id)
+            if endpoint_id not in self.hashes:
+                continue
+            if changed is False:
+                self.version += 1
+                changed = True
+            del self.hashes[endpoint_id]
+            del self.versions[endpoint_id]
+            self.unacked.add(endpoint_id)
+
+    def hash_pending(self):
+        """
+        Hash the endpoints recorded since the last sync, endpoints whose content changed get a new version.
+        """
+        endpoints = self.parent.node.data['alexa']
+        pending = self.pending
+        self.pending = set()
+        changed = False
+        for endpoint_id in pending:
+            endpoint = endpoints.get(endpoint_id)
+            if endpoint is None:  # Removed again.
+                continue
+            content_hash = self.content_hash(endpoint)
+            if self.hashes.get(endpoint_id) == content_hash:
+                continue
+            if changed is False:
+                self.version += 1
+                changed = True
+            self.hashes[endpoint_id] = content_hash
+            self.versions[endpoint_id] = self.version
+            self.unacked.add(endpoint_id)
+
+    def build_payload(self):
+        """
+        Build a patch against the acknowledged version, or the full document if there isn't one.
+
+        :return: dict
+        """
+        endpoints = self.parent.node.data['alexa']
+        if self.acked_version is None:
+            return {
+                'type': 'full',
+                'version': self.version,
+                'endpoints': {endpoint_id: {'version': self.versions.get(endpoint_id, self.version),
+                                            'hash': self.hashes.get(endpoint_id),
+                                            'endpoint': endpoint}
+                              for endpoint_id, endpoint in endpoints.items()},
+            }
+        changed = {}
+        removed = []
+        for endpoint_id in self.unacked:
+            if endpoint_id in self.hashes:
+                if self.acked_hashes.get(endpoint_id) != self.hashes[endpoint_id]:
+                    changed[endpoint_id] = {'version': self.versions[endpoint_id],
+                                            'hash': self.hashes[endpoint_id],
+                                            'endpoint': endpoints[endpoint_id]}
+            elif endpoint_id in self.acked_hashes:
+                removed.append(endpoint_id)
+        return {
+            'type': 'patch',
+            'base_version': self.acked_version,
+            'version': self.version,
+            'changed': changed,
+            'removed': removed,
+        }
+
+    def sync(self):
+        """
+        Send the changes to Yombo.
+
+        :return: Deferred that fires once Yombo responds.
+        """
+        if self.sending is not None:
+            d = Deferred()
+
+            def sync_again(result):
+                self.sync().chainDeferred(d)
+                return result
+            self.sending.addBoth(sync_again)
+            return d
+
+        if self.pending:
+            self.hash_pending()
+        if self.acked_version is None:
+            for endpoint_id in self.parent.node.data['alexa']:  # Loaded from the node without discovery.
+                if endpoint_id not in self.hashes:
+                    self.hashes[endpoint_id] = self.content_hash(self.parent.node.data['alexa'][endpoint_id])
+                    self.versions[endpoint_id] = self.version
+        elif len(self.unacked) == 0:
+            return succeed(None)
+
+        payload = self.build_payload()
+        sent_hashes = {endpoint_id: self.hashes.get(endpoint_id) for endpoint_id in
+                       (self.hashes if payload['type'] == 'full' else self.unacked)}
+        d = maybeDeferred(self.parent.endpoint_sync_sender, payload)
+        self.sending = d
+        d.addCallback(self.acknowledged, payload, sent_hashes)
+        d.addBoth(self.done_sending)
+        return d
+
+    def acknowledged(self, version, payload, sent_hashes):
+        """
+        Yombo responded with its current version. If it doesn't match, the next sync is a full upload.
+        """
+        if version != payload['version']:
+            self.acked_version = None
+            self.acked_hashes = {}
+            if payload['type'] == 'full':  # Fails the sync, so the node is saved instead.
+                raise YomboWarning("Yombo didn't accept the Alexa endpoints (ours: %s, Yombo: %s)" %
+                                   (payload['version'], version))
+            logger.info("Alexa endpoint versions diverged (ours: {ours}, Yombo: {theirs}), sending everything.",
+                        ours=payload['version'], theirs=version)
+            self.parent.persister.mark_dirty('alexa')
+            return
+        if payload['type'] == 'full':
+            self.acked_hashes = {}
+        for endpoint_id, content_hash in sent_hashes.items():
+            if content_hash is None:
+                self.acked_hashes.pop(endpoint_id, None)
+            else:
+                self.acked_hashes[endpoint_id] = content_hash
+            if self.hashes.get(endpoint_id) == content_hash:  # Hasn't changed again since being sent.
+                self.unacked.discard(endpoint_id)
+        self.acked_version = version
+
+    def done_sending(self, result):
+        self.sending = None
+        return result
+
+
+class _AllowList(object):
+    """
+    Set backed index of device or scene ids that Alexa is allowed to use. The node stores the ids as
+    a list under 'allowed', this keeps that list in sync whenever the set is changed.
+    """
+    def __init__(self, storage, on_change=None):
+        """
+        :param storage: The node data section to store the list in, such as node.data['devices'].
+        :param on_change: Optional callable, called after the list changes.
+        """
+        self.storage = storage
+        self.on_change = on_change
+        self.items = set(storage.get('allowed', []))
+        self.storage['allowed'] = sorted(self.items)
+
+    def __contains__(self, item_id):
+        return item_id in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item_ids):
+        """
+        Add item ids to the allow list.
+
+        :param item_ids: Iterable of ids.
+        :return: Set of ids that were actually added.
+        """
+        added = set(item_ids) - self.items
+        if len(added):
+            self.items |= added
+            self.sync()
+        return added
+
+    def remove(self, item_ids):
+        """
+        Remove item ids from the allow list.
+
+        :param item_ids: Iterable of ids.
+        :return: Set of ids that were actually removed.
+        """
+        removed = self.items & set(item_ids)
+        if len(removed):
+            self.items -= removed
+            self.sync()
+        return removed
+
+    def replace(self, item_ids):
+        """
+        Replace the allow list with new item ids.
+
+        :param item_ids: Iterable of ids.
+        :return: Tuple of sets: added ids, removed ids
+        """
+        item_ids = set(item_ids)
+        added = item_ids - self.items
+        removed = self.items - item_ids
+        if len(added) or len(removed):
+            self.items = item_ids
+            self.sync()
+        return added, removed
+
+    def sync(self):
+        """
+        Write the allowed ids back to the node data in the existing list format.
+        """
+        self.storage['allowed'] = sorted(self.items)
+        if self.on_change is not None:
+            self.on_change()
+
+
 class _UnsupportedInterface(Exception):
     """This entity does not support the requested Smart Home API interface."""
 
@@ -885,27 +2733,40 @@ class _UnsupportedInterface(Exception):
 class _UnsupportedProperty(Exception):
     """This entity does not support the requested Smart Home API property."""
 
+
+class _EndpointUnreachable(Exception):
+    """The endpoint's circuit breaker is open, the command wasn't sent."""
+
 class _AlexaController(object):
+    """
+    Base for the controllers of an interface. Controllers are created once per device and kept with the
+    interface, what they support is described by constant class attributes.
+    """
+    __slots__ = ('device',)
+
+    NAMESPACE = None
+    PROPERTIES = ()  # Constant {'name': ...} dictionaries, don't modify.
+    PROPERTY_NAMES = ()
+    PROACTIVELY_REPORTED = False  # Sent in ChangeReports, see _ChangeReporter.
+    RETRIEVABLE = False  # Can be asked for with ReportState.
+
     def __init__(self, device):
         self.device = device
 
-    def properties_retrievable(self):
-        return self.device.has_feature('pollable')
+    def name(self):
+        return self.NAMESPACE
 
-    @staticmethod
-    def properties_supported():
+    def properties_supported(self):
         """Return what properties this entity supports."""
-        return []
+        return self.PROPERTIES
 
-    @staticmethod
-    def properties_proactively_reported():
+    def properties_proactively_reported(self):
         """Return True if properties asynchronously reported."""
-        return False
+        return self.PROACTIVELY_REPORTED
 
-    @staticmethod
-    def properties_retrievable():
+    def properties_retrievable(self):
         """Return True if properties can be retrieved."""
-        return False
+        return self.RETRIEVABLE
 
     @staticmethod
     def get_property(name):
@@ -925,11 +2786,13 @@ class _AlexaController(object):
 
 
 class _AlexaBrightnessController(_AlexaController):
-    def name(self):
-        return 'Alexa.BrightnessController'
+    __slots__ = ()
 
-    def properties_supported(self):
-        return [{'name': 'brightness'}]
+    NAMESPACE = 'Alexa.BrightnessController'
+    PROPERTIES = ({'name': 'brightness'},)
+    PROPERTY_NAMES = ('brightness',)
+    PROACTIVELY_REPORTED = True
+    RETRIEVABLE = True
 
     def get_property(self, name):
         if name != 'brightness':
@@ -940,45 +2803,37 @@ class _AlexaBrightnessController(_AlexaController):
             return 0
 
 class _AlexaColorController(_AlexaController):
-    def name(self):
-        return 'Alexa.ColorController'
+    __slots__ = ()
 
-    def properties_supported(self):
-        return [{'name': 'color'}]
-        # return [{'name': 'hue'}, {'name': 'saturation'}, {'name': 'brightness'}]
+    NAMESPACE = 'Alexa.ColorController'
+    PROPERTIES = ({'name': 'color'},)
+    PROPERTY_NAMES = ('color',)
+    PROACTIVELY_REPORTED = True
+    RETRIEVABLE = True
 
     def get_property(self, name):
         if name != 'color':
             raise _UnsupportedProperty(name)
         try:
             hs = self.device.hs_color
-            # print("hs color: ")
-            # print(hs)
             return {
                 "hue": hs[0],
                 "saturation": hs[1],
                 "brightness": hs[2]
             }
-            # hs[1] = hs[1]/100
-            # hs[2] = hs[2]/100
-            # hs = self.device.hs_color
-            # hs[1] = hs[1]/100
-            # hs[2] = hs[2]/100
-            return hs
         except Exception as e:
-            print("Error with getting alexa her HS property. : %s" % e)
+            logger.warn("Error getting Alexa HS color property: {error}", error=e)
             return 0
 
 
 class _AlexaLockController(_AlexaController):
-    def name(self):
-        return 'Alexa.LockController'
+    __slots__ = ()
 
-    def properties_supported(self):
-        return [{'name': 'lockState'}]
-
-    def properties_retrievable(self):
-        return True
+    NAMESPACE = 'Alexa.LockController'
+    PROPERTIES = ({'name': 'lockState'},)
+    PROPERTY_NAMES = ('lockState',)
+    PROACTIVELY_REPORTED = True
+    RETRIEVABLE = True
 
     def get_property(self, name):
         if name != 'lockState':
@@ -992,14 +2847,11 @@ class _AlexaLockController(_AlexaController):
 
 # Untested!!
 class _AlexaChannelController(_AlexaController):
-    def name(self):
-        return 'Alexa.ChannelController'
-
-    def properties_supported(self):
-        return [{'name': 'channel'}]
+    __slots__ = ()
 
-    def properties_retrievable(self):
-        return True
+    NAMESPACE = 'Alexa.ChannelController'
+    PROPERTIES = ({'name': 'channel'},)
+    PROPERTY_NAMES = ('channel',)
 
     def get_property(self, name):
         if name != 'channel':
@@ -1011,14 +2863,13 @@ class _AlexaChannelController(_AlexaController):
 
 
 class _AlexaPowerController(_AlexaController):
-    def name(self):
-        return 'Alexa.PowerController'
-
-    def properties_supported(self):
-        return [{'name': 'powerState'}]
+    __slots__ = ()
 
-    def properties_retrievable(self):
-        return True
+    NAMESPACE = 'Alexa.PowerController'
+    PROPERTIES = ({'name': 'powerState'},)
+    PROPERTY_NAMES = ('powerState',)
+    PROACTIVELY_REPORTED = True
+    RETRIEVABLE = True
 
     def get_property(self, name):
         if name != 'powerState':
@@ -1029,101 +2880,115 @@ class _AlexaPowerController(_AlexaController):
         return 'OFF'
 
 
-def _AlexaSceneController(scene, request, response_type):
-    response = {
-        "alexaresponse": {
-            "context": {
-                "properties": [
-                    {
-                        "namespace": "Alexa.EndpointHealth",
-                        "name": "connectivity",
-                        "value": {
-                            "value": "OK"
-                        },
-                        "timeOfSample": str(datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.00Z")),
-                        "uncertaintyInMilliseconds": 200
-                    }
-                ]
-            },
-            "event": {
-                "header": {
-                    "namespace": "Alexa.SceneController",
-                    "name": response_type,
-                    "payloadVersion": "3",
-                    "messageId": str(uuid4()),
-                    # "correlationToken": "", filled in later by api_message()
-                },
-                "endpoint": {
-                    "endpointId": scene.scene_id
-                },
-                "payload": {
-                    "cause": {
-                        "type": "VOICE_INTERACTION"
-                    },
-                    "timestamp": str(datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.00Z"))
-                }
-            }
-        }
-    }
-    token = request['header'].get('correlationToken')
-    if token:
-        response['alexaresponse']['event']['header']['correlationToken'] = token
-    return response
+def _AlexaSceneController(scene, request, response_type, responses):
+    """
+    Generate the ActivationStarted or DeactivationStarted event for a scene.
+
+    :param scene: The scene.
+    :param request: The directive.
+    :param response_type: Either 'ActivationStarted' or 'DeactivationStarted'.
+    :param responses: ResponseBuilder to build the message with.
+    :return:
+    """
+    timestamp = responses.timestamp()
+    return responses.message({'header': request['header'], 'endpoint': {'endpointId': scene.scene_id}},
+                             name=response_type,
+                             namespace='Alexa.SceneController',
+                             payload={
+                                 'cause': {'type': 'VOICE_INTERACTION'},
+                                 'timestamp': timestamp,
+                             },
+                             context={'properties': [responses.endpoint_health(timestamp)]},
+                             )
+
 
 class _AlexaInterface(object):
+    """
+    Interfaces are kept per device in the resolved endpoint cache, the controllers are built the first
+    time they are needed and reused after that.
+    """
+    __slots__ = ('parent', 'device', '_controllers')
+
     def __init__(self, parent, device):
         self.parent = parent
         self.device = device
+        self._controllers = None
 
     @staticmethod
     def interfaces():
         return []
 
-    def serialize_properties(self, controllers=None, values=None):
-        """Return properties serialized for an API response. Goes into the context section."""
+    def serialize_properties(self, controllers=None, values=None, time_of_sample=None):
+        """
+        Return properties serialized for an API response. Goes into the context section.
+
+        :param controllers: A controller or list of controllers, defaults to all controllers of the interface.
+        :param values: Dictionary of property values to use instead of asking the device.
+        :param time_of_sample: Epoch time the values were sampled at, defaults to now.
+        :return:
+        """
+        started = perf_counter()
         if values is None or isinstance(values, dict) is False:
             values = {}
+        responses = self.parent.responses
+        time_of_sample = responses.timestamp(time_of_sample)
         properties = []
         if controllers is None:
             controllers = self.controllers()
-        elif isinstance(controllers, list) is False:
-            controllers = [controllers]
+        elif isinstance(controllers, _AlexaController):
+            controllers = (controllers,)
 
         for controller in controllers:
-            properties_supported = controller.properties_supported()
-            for property_supported in properties_supported:
-                if property_supported['name'] in values:
-                    value = values[property_supported['name']]
+            namespace = controller.NAMESPACE
+            for property_name in controller.PROPERTY_NAMES:
+                if property_name in values:
+                    value = values[property_name]
                 else:
-                    value = controller.get_property(property_supported['name'])
+                    value = controller.get_property(property_name)
                 properties.append({
-                    'name': property_supported['name'],
-                    'namespace': controller.name(),
+                    'name': property_name,
+                    'namespace': namespace,
                     'value': value,
-                    'timeOfSample': str(datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.00Z")),
+                    'timeOfSample': time_of_sample,
                     'uncertaintyInMilliseconds': 200,
                 })
 
-        properties.append({
-            "namespace": "Alexa.EndpointHealth",
-            "name": "connectivity",
-            "value": {
-                "value": "OK"
-            },
-            "timeOfSample": str(datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.00Z")),
-            "uncertaintyInMilliseconds": 200
-        })
+        device = self.device
+        properties.append(responses.endpoint_health(
+            time_of_sample, self.parent.circuit_breakers.connectivity(device.device_id, device.gateway_id)))
+        if self.parent.stats_key is not None:
+            self.parent.directive_stats.record(self.parent.stats_key, 'serialize', perf_counter() - started)
         return {'properties': properties}
 
     def controllers(self):
+        """
+        Return the controllers of the interface, as a tuple.
+        """
+        if self._controllers is None:
+            self._controllers = tuple(self.build_controllers())
+        return self._controllers
+
+    def controller(self, controller_class):
+        """
+        Return the interface's controller of the given class, or a new one if the interface doesn't have it.
+        """
+        for controller in self.controllers():
+            if controller.__class__ is controller_class:
+                return controller
+        return controller_class(self.device)
+
+    def build_controllers(self):
         return []
 
 
 class _LightInterface(_AlexaInterface):
-    def controllers(self, controller_name=None):
+    __slots__ = ()
+
+    def build_controllers(self):
         has_device_feature = self.device.has_device_feature
         controllers = []
-        # controllers.append(_AlexaPowerController(self.device))
+        if has_device_feature(FEATURE_POWER_CONTROL):
+            controllers.append(_AlexaPowerController(self.device))
         if has_device_feature(FEATURE_BRIGHTNESS):
             controllers.append(_AlexaBrightnessController(self.device))
         if has_device_feature(FEATURE_RGB_COLOR) or has_device_feature(FEATURE_XY_COLOR) or \
@@ -1136,20 +3001,38 @@ class _LightInterface(_AlexaInterface):
 
 # Untested.
 class _ChannelInterface(_AlexaInterface):
-    def controllers(self):
+    __slots__ = ()
+
+    def build_controllers(self):
         return [_AlexaChannelController(self.device),]
 
 
 class _LockInterface(_AlexaInterface):
-    def controllers(self):
+    __slots__ = ()
+
+    def build_controllers(self):
         return [_AlexaLockController(self.device),]
 
 
 class _SwitchInterface(_AlexaInterface):
-    def controllers(self):
-        return [_AlexaPowerController(self.device),]
+    __slots__ = ()
+
+    def build_controllers(self):
+        if self.device.has_device_feature(FEATURE_POWER_CONTROL):
+            return [_AlexaPowerController(self.device),]
+        return []
 
 
 class _SceneInterface(_AlexaInterface):
-    def controllers(self):
+    __slots__ = ()
+
+    def build_controllers(self):
         return [_AlexaPowerController(self.device),]
+
+
+# Namespaces sent in ChangeReports, the controllers discovery advertises as proactivelyReported.
+REPORTED_NAMESPACES = frozenset(['Alexa.EndpointHealth'] + [
+    controller_class.NAMESPACE for controller_class in (_AlexaBrightnessController, _AlexaColorController,
+                                                        _AlexaLockController, _AlexaChannelController,
+                                                        _AlexaPowerController)
+    if controller_class.PROACTIVELY_REPORTED])
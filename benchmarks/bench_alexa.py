@@ -0,0 +1,246 @@
+"""
+Microbenchmarks for the Amazon Alexa module: discovery, endpoint generation and response building.
+
+Runs offline using the stand-in libraries from fakes.py, and reports operations per second, time per
+call and peak memory. Results can be saved to a JSON file and compared against an earlier run::
+
+    python -m yombo.modules.amazonalexa.benchmarks.bench_alexa --sizes 100,1000,10000 --output new.json
+    python -m yombo.modules.amazonalexa.benchmarks.bench_alexa --compare old.json
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+
+:copyright: Copyright 2018 by Yombo.
+:license: LICENSE for details.
+"""
+import argparse
+from datetime import datetime
+import gc
+import json
+import platform
+import sys
+from time import perf_counter
+import tracemalloc
+
+from yombo.modules.amazonalexa import codec
+from yombo.modules.amazonalexa.benchmarks.fakes import build_module, disable_rate_limits
+
+DEFAULT_SIZES = (100, 1000, 10000, 50000)
+
+
+def sample_directive(namespace, name, endpoint_id, endpoint_type='device', payload=None):
+    return {
+        'header': {
+            'namespace': namespace,
+            'name': name,
+            'payloadVersion': '3',
+            'messageId': 'benchmark',
+            'correlationToken': 'benchmark-token',
+        },
+        'endpoint': {
+            'endpointId': endpoint_id,
+            'cookie': {'endpoint_type': endpoint_type},
+        },
+        'payload': payload or {},
+    }
+
+
+def reset_discovery(module):
+    module.node.data['alexa'].clear()
+    module.discovery_fingerprints.clear()
+    module.capability_cache.clear()
+
+
+def bench_discovery_cold(module):
+    def run():
+        reset_discovery(module)
+        module.discover_now(save=False)
+    return run
+
+
+def bench_discovery_warm(module):
+    module.discover_now(save=False)
+
+    def run():
+        module.discover_now(save=False)
+    return run
+
+
+def bench_generate_device_endpoint(module):
+    devices = list(module._Devices.devices.values())
+    index = [0]
+
+    def run():
+        index[0] = (index[0] + 1) % len(devices)
+        module.generate_device_endpoint(devices[index[0]])
+    return run
+
+
+def bench_generate_scene_endpoint(module):
+    scenes = list(module._Scenes.scenes.values())
+    index = [0]
+
+    def run():
+        index[0] = (index[0] + 1) % len(scenes)
+        module.generate_scene_endpoint(scenes[index[0]])
+    return run
+
+
+def bench_serialize_properties(module):
+    interfaces = [interface for interface in (module.find_interface(device)
+                                              for device in module._Devices.devices.values())
+                  if interface is not None]
+    index = [0]
+
+    def run():
+        index[0] = (index[0] + 1) % len(interfaces)
+        interfaces[index[0]].serialize_properties()
+    return run
+
+
+def bench_api_message(module):
+    device_id = next(iter(module._Devices.devices))
+    request = sample_directive('Alexa.PowerController', 'TurnOn', device_id)
+    context = {'properties': []}
+
+    def run():
+        module.api_message(request, context=context)
+    return run
+
+
+def bench_get_api_response(module):
+    device_id = next(device.device_id for device in module._Devices.devices.values()
+                     if module.build_interface(device) is not None)
+    request = sample_directive('Alexa.PowerController', 'TurnOn', device_id)
+    disable_rate_limits(module)
+    index = [0]
+
+    def run():
+        index[0] += 1  # Unique messageId, otherwise the idempotency cache answers.
+        request['header']['messageId'] = 'benchmark-%d' % index[0]
+        module.get_api_response(request)
+    return run
+
+
+def bench_encode_response(module):
+    device = next(device for device in module._Devices.devices.values()
+                  if module.find_interface(device) is not None)
+    request = sample_directive('Alexa.PowerController', 'TurnOn', device.device_id)
+    response = module.api_message(request, context=module.find_interface(device).serialize_properties())
+
+    def run():
+        codec.encode(response)
+    return run
+
+
+BENCHMARKS = {
+    'discovery_cold': bench_discovery_cold,
+    'discovery_warm': bench_discovery_warm,
+    'generate_device_endpoint': bench_generate_device_endpoint,
+    'generate_scene_endpoint': bench_generate_scene_endpoint,
+    'serialize_properties': bench_serialize_properties,
+    'api_message': bench_api_message,
+    'get_api_response': bench_get_api_response,
+    'encode_response': bench_encode_response,
+}
+
+
+def measure(run, min_time):
+    """
+    Call run() until at least min_time seconds have passed.
+
+    :return: dict of results.
+    """
+    run()  # Warm up.
+    calls = 0
+    gc.collect()
+    started = perf_counter()
+    elapsed = 0
+    while elapsed < min_time:
+        run()
+        calls += 1
+        elapsed = perf_counter() - started
+    return {
+        'calls': calls,
+        'ops_per_sec': round(calls / elapsed, 2),
+        'per_call_us': round(elapsed / calls * 1000000, 3),
+    }
+
+
+def measure_memory(run):
+    """
+    Peak memory allocated during a single call, in KiB.
+    """
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def run_benchmarks(sizes, names, min_time):
+    results = {}
+    for size in sizes:
+        module = build_module(device_count=size, scene_count=max(1, size // 10))
+        for name in names:
+            run = BENCHMARKS[name](module)
+            result = measure(run, min_time)
+            result['peak_kib'] = measure_memory(run)
+            results.setdefault(name, {})[str(size)] = result
+            print("%-26s %7d  %12.2f ops/s  %12.3f us/call  %10.1f KiB peak" %
+                  (name, size, result['ops_per_sec'], result['per_call_us'], result['peak_kib']))
+    return results
+
+
+def compare(results, previous):
+    """
+    Print the change of each result against a previous run.
+    """
+    print("\nCompared to previous run (positive is faster):")
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            try:
+                old = previous['results'][name][size]
+            except KeyError:
+                continue
+            change = (result['ops_per_sec'] / old['ops_per_sec'] - 1) * 100
+            memory = result['peak_kib'] - old['peak_kib']
+            print("%-26s %7s  %+8.1f%% ops/s  %+10.1f KiB peak" % (name, size, change, memory))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Amazon Alexa module microbenchmarks.")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma separated number of devices to generate.")
+    parser.add_argument('--benchmarks', default=','.join(BENCHMARKS),
+                        help="Comma separated benchmarks to run.")
+    parser.add_argument('--min-time', type=float, default=1.0, help="Seconds to run each benchmark.")
+    parser.add_argument('--json-backend', help="JSON backend to use, one of: %s." % ', '.join(codec.BACKENDS))
+    parser.add_argument('--output', help="Save the results to this JSON file.")
+    parser.add_argument('--compare', help="Compare the results to this previously saved JSON file.")
+    args = parser.parse_args(argv)
+
+    codec.use_backend(args.json_backend)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = [name for name in args.benchmarks.split(',') if name in BENCHMARKS]
+    results = run_benchmarks(sizes, names, args.min_time)
+
+    output = {
+        'meta': {
+            'created': datetime.utcnow().isoformat(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'json_backend': codec.backend,
+        },
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(results, json.load(handle))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(output, handle, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
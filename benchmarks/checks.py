@@ -0,0 +1,93 @@
+"""
+Regression checks for the Amazon Alexa module, run offline against the stand-in libraries from fakes.py::
+
+    python -m yombo.modules.amazonalexa.benchmarks.checks
+
+Each check raises AssertionError if the module misbehaves.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+
+:copyright: Copyright 2018 by Yombo.
+:license: LICENSE for details.
+"""
+import sys
+
+from yombo.modules.amazonalexa.benchmarks.bench_alexa import sample_directive
+from yombo.modules.amazonalexa.benchmarks.fakes import build_module, disable_rate_limits
+
+
+def check_wait_raises():
+    """
+    wait_for_command_to_finish() raising right away must fail that command only, and not leave the
+    device stuck with its in flight slot taken.
+    """
+    module = build_module(device_count=1)
+    scheduler = module.command_scheduler
+    device = next(iter(module._Devices.devices.values()))
+    devices = module._Devices
+    wait_for_command_to_finish = devices.wait_for_command_to_finish
+
+    def raise_once(request_id, timeout=5):
+        devices.wait_for_command_to_finish = wait_for_command_to_finish
+        raise KeyError("Request id not found")
+    devices.wait_for_command_to_finish = raise_once
+
+    results = []
+    scheduler.submit(device, device.turn_on).addBoth(results.append)
+    scheduler.submit(device, device.turn_off).addBoth(results.append)
+
+    assert len(results) == 2, "Commands didn't finish: %r" % results
+    assert results[0].check(KeyError) is not None, "First command should fail: %r" % results[0]
+    assert isinstance(results[1], str), "Second command should be sent: %r" % results[1]
+    assert scheduler.in_flight == 0, "In flight slot leaked: %d" % scheduler.in_flight
+    assert device.device_id not in scheduler.active, "Device left active."
+    assert devices.command_count == 2
+
+
+def check_error_not_cached():
+    """
+    A directive answered with an ErrorResponse must not be stored by the idempotency cache, Alexa's
+    retry with the same messageId sends the command again.
+    """
+    module = build_module(device_count=1)
+    disable_rate_limits(module)
+    module.discover_now(save=False)
+    device = next(iter(module._Devices.devices.values()))
+    turn_on = device.turn_on
+
+    def raise_once(**kwargs):
+        device.turn_on = turn_on
+        raise RuntimeError("Device didn't answer")
+    device.turn_on = raise_once
+
+    directive = sample_directive('Alexa.PowerController', 'TurnOn', device.device_id)
+    first = module.get_api_response(directive)
+    retry = module.get_api_response(directive)
+
+    assert first['alexaresponse']['event']['header']['name'] == 'ErrorResponse', "First should fail: %r" % first
+    assert retry['alexaresponse']['event']['header']['name'] == 'Response', "Retry got: %r" % retry
+    assert module._Devices.command_count == 1
+
+
+CHECKS = {
+    'wait_raises': check_wait_raises,
+    'error_not_cached': check_error_not_cached,
+}
+
+
+def main(argv=None):
+    names = argv if argv else list(CHECKS)
+    failed = 0
+    for name in names:
+        try:
+            CHECKS[name]()
+        except AssertionError as e:
+            failed += 1
+            print("FAIL %s: %s" % (name, e))
+        else:
+            print("ok   %s" % name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
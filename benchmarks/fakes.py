@@ -0,0 +1,303 @@
+"""
+Stand-in gateway libraries for benchmarking the Amazon Alexa module without a running gateway.
+
+The stand-ins only implement what the Alexa module uses. Devices are generated synthetically across
+every platform and feature combination the module knows about.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+
+:copyright: Copyright 2018 by Yombo.
+:license: LICENSE for details.
+"""
+from itertools import cycle, product
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+from yombo.constants.features import (FEATURE_BRIGHTNESS, FEATURE_COLOR_TEMP, FEATURE_POWER_CONTROL,
+    FEATURE_RGB_COLOR, FEATURE_XY_COLOR)
+from yombo.constants.platforms import (PLATFORM_COLOR_LIGHT, PLATFORM_LIGHT, PLATFORM_FAN, PLATFORM_APPLIANCE,
+    PLATFORM_SWITCH, PLATFORM_LOCK, PLATFORM_TV)
+
+PLATFORMS = (PLATFORM_SWITCH, PLATFORM_APPLIANCE, PLATFORM_LIGHT, PLATFORM_COLOR_LIGHT, PLATFORM_FAN,
+             PLATFORM_LOCK, PLATFORM_TV, 'climate', 'camera', 'relay', 'device')
+
+FEATURE_NAMES = (FEATURE_POWER_CONTROL, FEATURE_BRIGHTNESS, FEATURE_COLOR_TEMP, FEATURE_RGB_COLOR,
+                 FEATURE_XY_COLOR, 'channel_control', 'input_control', 'dual_setpoints')
+
+GATEWAY_ID = 'gw_local'
+
+
+def feature_combinations():
+    """
+    Every on/off combination of FEATURE_NAMES, as FEATURES dictionaries.
+    """
+    for values in product((True, False), repeat=len(FEATURE_NAMES)):
+        yield dict(zip(FEATURE_NAMES, values))
+
+
+class FakeDevice(object):
+    """
+    Device with the attributes and command methods the Alexa module uses. Commands finish after
+    command_latency seconds.
+    """
+    def __init__(self, devices, device_id, platform, features, label):
+        self._devices = devices
+        self.device_id = device_id
+        self.PLATFORM = platform
+        self.FEATURES = features
+        self.label = label
+        self.full_label = "Home %s" % label
+        self.description = "Synthetic %s" % platform
+        self.device_mfg = 'Yombo'
+        self.gateway_id = GATEWAY_ID
+        self.enabled_status = 1
+        self.is_on = False
+        self.is_locked = True
+        self.percent = 0
+        self.hs_color = (0, 0, 0)
+
+    def has_device_feature(self, feature):
+        return self.FEATURES.get(feature, False) is True
+
+    def has_feature(self, feature):
+        return self.has_device_feature(feature)
+
+    def turn_on(self, **kwargs):
+        self.is_on = True
+        return self._devices.new_command(self)
+
+    def turn_off(self, **kwargs):
+        self.is_on = False
+        return self._devices.new_command(self)
+
+    def set_percent(self, percent, **kwargs):
+        self.percent = percent
+        self.is_on = percent > 0
+        return self._devices.new_command(self)
+
+    def set_color(self, rgb, **kwargs):
+        return self._devices.new_command(self)
+
+    def set_channel(self, channel, **kwargs):
+        return self._devices.new_command(self)
+
+    def lock(self, **kwargs):
+        self.is_locked = True
+        return self._devices.new_command(self)
+
+    def unlock(self, **kwargs):
+        self.is_locked = False
+        return self._devices.new_command(self)
+
+
+class FakeDevices(object):
+    """
+    Stand-in for the _Devices library.
+
+    :param count: Number of devices to generate.
+    :param command_latency: Seconds device commands take to finish.
+    """
+    def __init__(self, count=0, command_latency=0):
+        self.devices = {}
+        self.command_latency = command_latency
+        self.command_count = 0
+        self.commands = {}  # request_id -> Deferred
+        # Platforms change fastest, so even small counts cover every platform.
+        combinations = cycle(product(list(feature_combinations()), PLATFORMS))
+        for index in range(count):
+            features, platform = next(combinations)
+            device_id = 'device%06d' % index
+            self.devices[device_id] = FakeDevice(self, device_id, platform, dict(features), "Device %d" % index)
+
+    def __getitem__(self, device_id):
+        return self.devices[device_id]
+
+    def __contains__(self, device_id):
+        return device_id in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def new_command(self, device):
+        self.command_count += 1
+        request_id = 'request%d' % self.command_count
+        d = Deferred()
+        self.commands[request_id] = d
+        if self.command_latency > 0:
+            reactor.callLater(self.command_latency, self.finish_command, request_id)
+        else:
+            self.finish_command(request_id)
+        return request_id
+
+    def finish_command(self, request_id):
+        d = self.commands.pop(request_id, None)
+        if d is not None:
+            d.callback(request_id)
+
+    def wait_for_command_to_finish(self, request_id, timeout=5):
+        d = self.commands.get(request_id)
+        if d is None:  # Already finished.
+            return succeed(request_id)
+        waiter = Deferred()
+        d.addCallback(lambda result: waiter.callback(result) or result)
+        return waiter
+
+
+class FakeScene(object):
+    def __init__(self, scene_id, label):
+        self.scene_id = scene_id
+        self.label = label
+        self.gateway_id = GATEWAY_ID
+        self.status = 1
+
+    def effective_status(self):
+        return self.status
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class FakeScenes(object):
+    """
+    Stand-in for the _Scenes library.
+    """
+    def __init__(self, count=0):
+        self.scenes = {}
+        for index in range(count):
+            scene_id = 'scene%06d' % index
+            self.scenes[scene_id] = FakeScene(scene_id, "Scene %d" % index)
+
+    def __getitem__(self, scene_id):
+        return self.scenes[scene_id]
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scenes
+
+    def __len__(self):
+        return len(self.scenes)
+
+
+class FakeNode(object):
+    def __init__(self, data):
+        self.node_id = 'node_alexa'
+        self.data = data
+        self.save_count = 0
+
+    def save(self):
+        self.save_count += 1
+        return succeed(True)
+
+
+class FakeNodes(object):
+    """
+    Stand-in for the _Nodes library, holds the single Alexa node.
+    """
+    def __init__(self):
+        self.nodes = {}
+
+    def search(self, criteria):
+        return dict(self.nodes)
+
+    def create(self, **kwargs):
+        node = FakeNode(kwargs['data'])
+        self.nodes[node.node_id] = node
+        return succeed(node)
+
+
+class FakeAuthKey(object):
+    auth_id = 'authkey_alexa'
+
+    def enable(self):
+        pass
+
+    def attach_role(self, role):
+        pass
+
+
+class FakeAuthKeys(object):
+    def __init__(self):
+        self.authkey = FakeAuthKey()
+
+    def get(self, label):
+        return self.authkey
+
+    def add_authkey(self, data):
+        return self.authkey
+
+
+class FakeConfigs(object):
+    values = {
+        ('core', 'is_master'): True,
+        ('dns', 'fqdn'): 'example.yombo.me',
+        ('webinterface', 'secure_port'): 8443,
+    }
+
+    def get(self, section, option, default=None, set_if_missing=True):
+        return self.values.get((section, option), default)
+
+
+class FakeNotifications(object):
+    def add(self, notice):
+        pass
+
+
+class FakeGateways(object):
+    local_id = GATEWAY_ID
+
+
+class FakeYomboAPI(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, body=None):
+        self.requests.append((method, url, body))
+        return succeed({'code': 200})
+
+
+def build_module(device_count=0, scene_count=0, allow_all=True, command_latency=0):
+    """
+    Creates an AmazonAlexa module instance wired to the stand-in libraries and loads the node, without
+    starting any of the module's loops.
+
+    :param device_count: Number of synthetic devices.
+    :param scene_count: Number of synthetic scenes.
+    :param allow_all: If True, every device and scene is added to the allow lists.
+    :param command_latency: Seconds device commands take to finish.
+    :return: AmazonAlexa instance
+    """
+    from yombo.modules.amazonalexa.amazonalexa import AmazonAlexa
+
+    module = AmazonAlexa.__new__(AmazonAlexa)
+    module._Configs = FakeConfigs()
+    module._Notifications = FakeNotifications()
+    module._Devices = FakeDevices(device_count, command_latency)
+    module._Scenes = FakeScenes(scene_count)
+    module._Nodes = FakeNodes()
+    module._AuthKeys = FakeAuthKeys()
+    module._Gateways = FakeGateways()
+    module._YomboAPI = FakeYomboAPI()
+    module._init_()
+    module._load_()
+    module.event_sender = lambda events: None
+
+    module.gwid = GATEWAY_ID
+    module.node = FakeNode({'scenes': {'allowed': []}, 'devices': {'allowed': []}, 'configs': {}, 'alexa': {}})
+    module.load_node_data()
+    if allow_all:
+        module.allowed_devices.replace(module._Devices.devices.keys())
+        module.allowed_scenes.replace(module._Scenes.scenes.keys())
+    return module
+
+
+def disable_rate_limits(module):
+    """
+    Remove the admission control rate limits, so benchmarks measure directive handling instead of
+    rejections.
+    """
+    unlimited = float('inf')
+    module.admission_control.configure(rate=unlimited, burst=unlimited,
+                                       endpoint_rate=unlimited, endpoint_burst=unlimited)
@@ -0,0 +1,347 @@
+"""
+End to end load harness for the Alexa control route.
+
+Serves the real module_amazonalexa_routes handlers from a local Twisted web server, backed by the
+stand-in libraries from fakes.py with configurable device command latency. A corpus of directives is
+replayed over HTTP at a target concurrency and request rate, then throughput, latency percentiles and
+the error rate are reported::
+
+    python -m yombo.modules.amazonalexa.benchmarks.load_control --devices 500 --concurrency 50 --rate 400
+
+A corpus file, a JSON list of directives, can be given with --corpus. Otherwise a mix of TurnOn/TurnOff,
+SetBrightness, SetColor, Lock/Unlock and scene Activate directives is generated, each sent to endpoints
+that support it.
+
+Errors for directives the target endpoint doesn't support, and requests that failed in the harness's
+own HTTP client, are reported as harness errors. They aren't included in the error rate.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+
+:copyright: Copyright 2018 by Yombo.
+:license: LICENSE for details.
+"""
+import argparse
+from contextlib import contextmanager
+from io import BytesIO
+import json
+from random import Random
+from time import perf_counter
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, DeferredSemaphore, DeferredList
+from twisted.internet.task import deferLater
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from yombo.modules.amazonalexa import web_routes
+from yombo.modules.amazonalexa.benchmarks.bench_alexa import sample_directive
+from yombo.modules.amazonalexa.benchmarks.fakes import build_module, disable_rate_limits
+from yombo.modules.amazonalexa.stats import LatencyHistogram
+
+
+class FakeSession(object):
+    def has_access(self, *args, **kwargs):
+        return True
+
+
+def fake_require_auth(*args, **kwargs):
+    """
+    Replaces require_auth, every request is treated as authenticated.
+    """
+    def decorator(function):
+        def wrapper(webinterface, request, *args, **kwargs):
+            return function(webinterface, request, FakeSession(), *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class FakeWebapp(object):
+    """
+    Collects the routes added by module_amazonalexa_routes.
+    """
+    def __init__(self):
+        self.prefix = ''
+        self.routes = {}  # (path, method) -> handler
+
+    @contextmanager
+    def subroute(self, prefix):
+        previous = self.prefix
+        self.prefix = previous + prefix
+        yield self
+        self.prefix = previous
+
+    def route(self, path, methods=('GET',)):
+        def decorator(function):
+            for method in methods:
+                self.routes[(self.prefix + path, method.encode())] = function
+            return function
+        return decorator
+
+
+class FakeWebinterface(object):
+    def __init__(self, module):
+        self._Modules = {'AmazonAlexa': module}
+
+
+class RouteResource(Resource):
+    """
+    Twisted web resource that dispatches to the collected route handlers.
+    """
+    isLeaf = True
+
+    def __init__(self, webinterface, routes):
+        Resource.__init__(self)
+        self.webinterface = webinterface
+        self.routes = routes
+
+    def render(self, request):
+        handler = self.routes.get((request.path.decode(), request.method))
+        if handler is None:
+            request.setResponseCode(404)
+            return b"not found"
+
+        def write(result):
+            if isinstance(result, str):
+                result = result.encode()
+            request.write(result)
+            request.finish()
+
+        def failed(failure):
+            request.setResponseCode(500)
+            request.write(failure.getErrorMessage().encode())
+            request.finish()
+
+        d = maybeDeferred(handler, self.webinterface, request)
+        d.addCallbacks(write, failed)
+        return NOT_DONE_YET
+
+
+def supported_targets(module):
+    """
+    Endpoint ids by the interfaces their discovered endpoint has. Devices the module has no interface
+    for can't be controlled, they are left out. Call after discovery.
+
+    :return: dict of interface -> list of endpoint ids.
+    """
+    targets = {}
+    devices = module._Devices.devices
+    for endpoint_id, endpoint in module.node.data['alexa'].items():
+        device = devices.get(endpoint_id)
+        if device is not None and module.build_interface(device) is None:
+            continue
+        for capability in endpoint['capabilities']:
+            targets.setdefault(capability['interface'], []).append(endpoint_id)
+    return targets
+
+
+def is_supported(targets, directive):
+    """
+    Return True if the directive's endpoint supports its interface.
+
+    :param targets: dict of interface -> set of endpoint ids, from supported_targets().
+    """
+    endpoint = directive.get('endpoint')
+    if endpoint is None:  # Such as discovery, there is no endpoint to support it.
+        return True
+    return endpoint['endpointId'] in targets.get(directive['header']['namespace'], ())
+
+
+def build_corpus(module, size, seed=1):
+    """
+    Generate a mix of directives for the devices and scenes of the module. Each directive is sent to
+    an endpoint that supports it, directives no endpoint supports are left out of the mix.
+    """
+    random = Random(seed)
+    targets = supported_targets(module)
+
+    def power(endpoint_id):
+        return sample_directive('Alexa.PowerController', random.choice(('TurnOn', 'TurnOff')), endpoint_id)
+
+    def brightness(endpoint_id):
+        return sample_directive('Alexa.BrightnessController', 'SetBrightness', endpoint_id,
+                                payload={'brightness': random.randint(0, 100)})
+
+    def color(endpoint_id):
+        return sample_directive('Alexa.ColorController', 'SetColor', endpoint_id,
+                                payload={'color': {'hue': random.randint(0, 360),
+                                                   'saturation': random.random(),
+                                                   'brightness': random.random()}})
+
+    def lock(endpoint_id):
+        return sample_directive('Alexa.LockController', random.choice(('Lock', 'Unlock')), endpoint_id)
+
+    def scene(endpoint_id):
+        return sample_directive('Alexa.SceneController', 'Activate', endpoint_id, endpoint_type='scene')
+
+    mix = [(weight, generator, targets[interface]) for weight, interface, generator in (
+        (0.4, 'Alexa.PowerController', power),
+        (0.25, 'Alexa.BrightnessController', brightness),
+        (0.15, 'Alexa.ColorController', color),
+        (0.1, 'Alexa.LockController', lock),
+        (0.1, 'Alexa.SceneController', scene),
+    ) if interface in targets]
+    if len(mix) == 0:
+        raise ValueError("No endpoints support any of the corpus directives.")
+    weights = [weight for weight, generator, endpoint_ids in mix]
+    corpus = []
+    for index in range(size):
+        weight, generator, endpoint_ids = random.choices(mix, weights)[0]
+        corpus.append(generator(random.choice(endpoint_ids)))
+    return corpus
+
+
+def is_error(body):
+    try:
+        response = json.loads(body)
+    except ValueError:
+        return True
+    if isinstance(response, dict) is False:
+        return True
+    try:
+        return response['alexaresponse']['event']['header']['name'] == 'ErrorResponse'
+    except KeyError:
+        return False
+
+
+@inlineCallbacks
+def run_load(port, corpus, concurrency, rate, duration, unique_ids=True, supported=None):
+    """
+    Replay the corpus against the control route.
+
+    :param port: Local port the server listens on.
+    :param corpus: List of directives, sent in order and repeated as needed.
+    :param supported: List of booleans, one per corpus directive, False if the endpoint doesn't support
+        the directive. Errors for those are counted as harness errors. Defaults to all supported.
+    :param concurrency: Maximum requests in flight.
+    :param rate: Target requests per second, 0 for as fast as possible.
+    :param duration: Seconds to send requests for.
+    :param unique_ids: If True, each request gets a unique messageId so the idempotency cache doesn't
+        answer repeats of the corpus.
+    :return: dict of results.
+    """
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = concurrency
+    agent = Agent(reactor, pool=pool)
+    url = ("http://127.0.0.1:%d/api/v1/extended/alexa/control" % port).encode()
+    headers = Headers({b'Content-Type': [b'application/json']})
+    semaphore = DeferredSemaphore(concurrency)
+    histogram = LatencyHistogram()
+    counts = {'sent': 0, 'errors': 0, 'harness_errors': 0}
+
+    @inlineCallbacks
+    def send(body, harness_error):
+        started = perf_counter()
+        try:
+            response = yield agent.request(b'POST', url, headers, FileBodyProducer(BytesIO(body)))
+            content = yield readBody(response)
+            if response.code != 200 or is_error(content):
+                counts[harness_error] += 1
+        except Exception:  # The request never got an answer from the route.
+            counts['harness_errors'] += 1
+        histogram.record(perf_counter() - started)
+
+    interval = 1.0 / rate if rate > 0 else 0
+    deferreds = []
+    started = perf_counter()
+    while perf_counter() - started < duration:
+        index = counts['sent'] % len(corpus)
+        directive = corpus[index]
+        harness_error = 'errors' if supported is None or supported[index] else 'harness_errors'
+        if unique_ids:
+            directive = dict(directive, header=dict(directive['header'], messageId='load-%d' % counts['sent']))
+        body = json.dumps({'directive': directive}).encode()
+        counts['sent'] += 1
+        yield semaphore.acquire()
+        d = send(body, harness_error)
+        d.addBoth(lambda ignored: semaphore.release())
+        deferreds.append(d)
+        if interval:
+            wait = started + counts['sent'] * interval - perf_counter()
+            if wait > 0:
+                yield deferLater(reactor, wait, lambda: None)
+    yield DeferredList(deferreds)
+    elapsed = perf_counter() - started
+    yield pool.closeCachedConnections()
+
+    results = histogram.summary()
+    results['requests'] = counts['sent']
+    results['errors'] = counts['errors']
+    results['harness_errors'] = counts['harness_errors']
+    results['error_rate'] = round(counts['errors'] / max(1, counts['sent'] - counts['harness_errors']), 4)
+    results['throughput'] = round(counts['sent'] / elapsed, 2)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Amazon Alexa control route load harness.")
+    parser.add_argument('--devices', type=int, default=500, help="Number of synthetic devices.")
+    parser.add_argument('--scenes', type=int, default=20, help="Number of synthetic scenes.")
+    parser.add_argument('--command-latency', type=float, default=0.05, help="Seconds device commands take.")
+    parser.add_argument('--corpus', help="JSON file with a list of directives to replay.")
+    parser.add_argument('--corpus-size', type=int, default=1000, help="Directives to generate without --corpus.")
+    parser.add_argument('--keep-message-ids', action='store_true',
+                        help="Send the corpus messageIds as is, repeats are answered by the idempotency cache.")
+    parser.add_argument('--concurrency', type=int, default=20, help="Maximum requests in flight.")
+    parser.add_argument('--rate', type=float, default=0, help="Target requests per second, 0 for unlimited.")
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help="Module's global directive rate limit, 0 to disable admission control rate limits.")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to run for.")
+    parser.add_argument('--output', help="Save the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    module = build_module(device_count=args.devices, scene_count=args.scenes,
+                          command_latency=args.command_latency)
+    module.discover_now(save=False)
+    if args.rate_limit > 0:
+        module.admission_control.configure(rate=args.rate_limit, burst=args.rate_limit * 2,
+                                           endpoint_rate=5, endpoint_burst=10)
+    else:
+        disable_rate_limits(module)
+
+    webapp = FakeWebapp()
+    require_auth = web_routes.require_auth
+    web_routes.require_auth = fake_require_auth
+    try:
+        web_routes.module_amazonalexa_routes(webapp)
+    finally:
+        web_routes.require_auth = require_auth
+
+    if args.corpus:
+        with open(args.corpus) as handle:
+            corpus = json.load(handle)
+    else:
+        corpus = build_corpus(module, args.corpus_size)
+    targets = {interface: set(endpoint_ids) for interface, endpoint_ids in supported_targets(module).items()}
+    supported = [is_supported(targets, directive) for directive in corpus]
+    if not all(supported):
+        print("%d of %d corpus directives target endpoints that don't support them." %
+              (supported.count(False), len(corpus)))
+
+    listener = reactor.listenTCP(0, Site(RouteResource(FakeWebinterface(module), webapp.routes)),
+                                 interface='127.0.0.1')
+
+    def report(results):
+        print("requests: %(requests)d  throughput: %(throughput).1f/s  errors: %(errors)d (%(error_rate).2f%%)"
+              "  harness errors: %(harness_errors)d" % dict(results, error_rate=results['error_rate'] * 100))
+        print("latency ms  p50: %(p50).2f  p95: %(p95).2f  p99: %(p99).2f  max: %(max).2f" % results)
+        if args.output:
+            with open(args.output, 'w') as handle:
+                json.dump(dict(results, arguments=vars(args)), handle, indent=2, sort_keys=True)
+
+    def stop(result):
+        listener.stopListening()
+        reactor.stop()
+        return result
+
+    d = run_load(listener.getHost().port, corpus, args.concurrency, args.rate, args.duration,
+                 unique_ids=not args.keep_message_ids, supported=supported)
+    d.addCallback(report)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(stop)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+JSON encoding and decoding for the Alexa routes and events.
+
+Uses orjson or ujson when one is installed, falling back to the standard library json module. The
+backend can be changed with use_backend(), such as from a setting or to compare backends in a
+benchmark. Call codec.encode() and codec.decode() through the module so the current backend is used.
+
+encode() always returns bytes.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+
+:copyright: Copyright 2018 by Yombo.
+:license: LICENSE for details.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _json_encode(value):
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def _json_decode(data):
+    return json.loads(data)
+
+
+def _orjson_encode(value):
+    try:
+        return orjson.dumps(value)
+    except TypeError:  # Such as non-string keys, which the standard library allows.
+        return _json_encode(value)
+
+
+def _ujson_encode(value):
+    return ujson.dumps(value, ensure_ascii=False).encode()
+
+
+BACKENDS = {}  # name -> (encode, decode), fastest first.
+if orjson is not None:
+    BACKENDS['orjson'] = (_orjson_encode, orjson.loads)
+if ujson is not None:
+    BACKENDS['ujson'] = (_ujson_encode, ujson.loads)
+BACKENDS['json'] = (_json_encode, _json_decode)
+
+backend = None
+encode = None
+decode = None
+
+
+def use_backend(name=None):
+    """
+    Select the JSON backend.
+
+    :param name: One of BACKENDS, defaults to the fastest one installed.
+    :return: Name of the backend now in use.
+    """
+    global backend, encode, decode
+    if name is None:
+        name = next(iter(BACKENDS))
+    if name not in BACKENDS:
+        raise KeyError("JSON backend '%s' isn't installed." % name)
+    backend = name
+    encode, decode = BACKENDS[name]
+    return name
+
+
+use_backend()
@@ -0,0 +1,118 @@
+"""
+Builds the responses and events sent to Alexa, doing as little work per response as possible.
+
+Timestamps are formatted once per tick, message ids come from a counter instead of uuid4(), and the
+EndpointHealth property is shared between every response sampled at the same time. Responses are
+never modified once built, so the shared fragments are safe to reuse.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+
+:copyright: Copyright 2018 by Yombo.
+:license: LICENSE for details.
+"""
+from datetime import datetime
+from itertools import count
+from time import time
+from uuid import uuid4
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.00Z"
+
+HEALTH_VALUES = {
+    'OK': {"value": "OK"},
+    'UNREACHABLE': {"value": "UNREACHABLE"},
+}
+
+
+class ResponseBuilder(object):
+    """
+    Builds Alexa response and event messages.
+    """
+    __slots__ = ('_tick', '_timestamp', '_health', '_message_prefix', '_message_counter')
+
+    def __init__(self):
+        self._tick = None
+        self._timestamp = None
+        self._health = None
+        self._message_prefix = "%s-" % uuid4()
+        self._message_counter = count(1)
+
+    def timestamp(self, timestamp=None):
+        """
+        Format an epoch time for Alexa, such as timeOfSample. The format only has whole seconds, so the
+        formatted string is reused until the second changes.
+
+        :param timestamp: Epoch time, defaults to now.
+        :return: String
+        """
+        if timestamp is None:
+            timestamp = time()
+        tick = int(timestamp)
+        if tick != self._tick:
+            self._tick = tick
+            self._timestamp = datetime.utcfromtimestamp(tick).strftime(TIMESTAMP_FORMAT)
+            self._health = None
+        return self._timestamp
+
+    def message_id(self):
+        """
+        Return a new message id, unique for the life of the gateway process.
+        """
+        return self._message_prefix + str(next(self._message_counter))
+
+    def endpoint_health(self, time_of_sample, connectivity='OK'):
+        """
+        The Alexa.EndpointHealth property included with every endpoint state. The same dictionary is
+        returned for every reachable endpoint sampled with the current timestamp.
+
+        :param time_of_sample: Formatted timestamp from timestamp().
+        :param connectivity: Either 'OK' or 'UNREACHABLE'.
+        :return:
+        """
+        if time_of_sample is self._timestamp and connectivity == 'OK':
+            if self._health is None:
+                self._health = self.build_endpoint_health(time_of_sample)
+            return self._health
+        return self.build_endpoint_health(time_of_sample, connectivity)
+
+    @staticmethod
+    def build_endpoint_health(time_of_sample, connectivity='OK'):
+        return {
+            "namespace": "Alexa.EndpointHealth",
+            "name": "connectivity",
+            "value": HEALTH_VALUES[connectivity],
+            "timeOfSample": time_of_sample,
+            "uncertaintyInMilliseconds": 200
+        }
+
+    def message(self, request, name='Response', namespace='Alexa', payload=None, context=None):
+        """
+        Build a response or event message.
+
+        :param request: The directive being responded to, used for the correlation token and endpoint.
+        :param name: Name for the event header.
+        :param namespace: Namespace for the event header.
+        :param payload: Event payload.
+        :param context: Context, such as from serialize_properties().
+        :return: dict
+        """
+        header = {
+            'namespace': namespace,
+            'name': name,
+            'messageId': self._message_prefix + str(next(self._message_counter)),
+            'payloadVersion': '3',
+        }
+        request_header = request['header']
+        if 'correlationToken' in request_header and request_header['correlationToken']:
+            header['correlationToken'] = request_header['correlationToken']
+
+        event = {
+            'header': header,
+            'payload': payload if payload is not None else {},
+        }
+        if 'endpoint' in request:
+            event['endpoint'] = request['endpoint']
+
+        alexaresponse = {'event': event}
+        if context is not None:
+            alexaresponse['context'] = context
+        return {'alexaresponse': alexaresponse, 'meta': {}}
@@ -0,0 +1,210 @@
+"""
+Lightweight statistics used to instrument the Amazon Alexa module.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+
+:copyright: Copyright 2018 by Yombo.
+:license: LICENSE for details.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from math import ceil
+
+
+def _bucket_bounds(minimum=0.00001, maximum=120, growth=1.15):
+    """
+    Upper bounds, in seconds, of the histogram buckets. Each bucket is 15% wider than the previous one,
+    keeping the percentile error under 15% while only needing about 120 buckets.
+    """
+    bounds = []
+    bound = minimum
+    while bound < maximum:
+        bounds.append(bound)
+        bound *= growth
+    return tuple(bounds)
+
+BUCKET_BOUNDS = _bucket_bounds()
+
+
+class LatencyHistogram(object):
+    """
+    Log-scale histogram of durations, in seconds. Recording is a bisect and an increment, so it's cheap
+    enough to leave enabled all the time.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """
+        Return the approximate percentile, in seconds.
+
+        :param percent: Such as 95 or 99.
+        :return: float
+        """
+        if self.count == 0:
+            return 0.0
+        target = max(1, ceil(self.count * percent / 100.0))
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                if index >= len(BUCKET_BOUNDS):
+                    return self.max
+                return min(BUCKET_BOUNDS[index], self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Summary of the histogram, times are in milliseconds.
+
+        :return: dict
+        """
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'p50': round(self.percentile(50) * 1000, 3),
+            'p95': round(self.percentile(95) * 1000, 3),
+            'p99': round(self.percentile(99) * 1000, 3),
+            'max': round(self.max * 1000, 3),
+        }
+
+
+class DirectiveStats(object):
+    """
+    Latency histograms of each stage of processing a directive, kept per namespace/name.
+    """
+    STAGES = ('decode', 'lookup', 'handler', 'serialize', 'message', 'encode')
+
+    def __init__(self):
+        self.histograms = {}  # key -> stage -> LatencyHistogram
+
+    def record(self, key, stage, seconds):
+        """
+        Record the duration of a stage.
+
+        :param key: Directive key, such as 'Alexa.PowerController.TurnOn'.
+        :param stage: One of STAGES.
+        :param seconds: Duration in seconds.
+        """
+        try:
+            self.histograms[key][stage].record(seconds)
+        except KeyError:
+            stages = self.histograms.setdefault(key, {})
+            stages[stage] = LatencyHistogram()
+            stages[stage].record(seconds)
+
+    def summary(self):
+        """
+        Summaries of every histogram, ordered by directive key and then stage.
+
+        :return: dict of key -> stage -> summary
+        """
+        results = {}
+        for key in sorted(self.histograms):
+            stages = self.histograms[key]
+            results[key] = {stage: stages[stage].summary() for stage in self.STAGES if stage in stages}
+        return results
+
+    def clear(self):
+        self.histograms.clear()
+
+
+class DeviceLatency(object):
+    """
+    Command completion latency of a single device: an exponentially weighted moving average, and a
+    histogram for the percentiles.
+    """
+    __slots__ = ('label', 'ewma', 'histogram')
+
+    def __init__(self, label):
+        self.label = label
+        self.ewma = None
+        self.histogram = LatencyHistogram()
+
+    def record(self, seconds, alpha):
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma += alpha * (seconds - self.ewma)
+        self.histogram.record(seconds)
+
+
+class DeviceLatencies(object):
+    """
+    Tracks how long each device takes to finish commands, and derives per device command timeouts
+    from it. A fast device fails fast, and a slow device gets the time it usually needs.
+
+    Until a device has min_samples completed commands, default_timeout is used. After that, the
+    timeout is the larger of the p99 and the moving average, times multiplier, kept between
+    min_timeout and max_timeout.
+    """
+    def __init__(self, default_timeout=5, min_timeout=1, max_timeout=60, multiplier=2, min_samples=5,
+                 alpha=0.2):
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self.devices = {}  # device_id -> DeviceLatency
+
+    def record(self, device_id, label, seconds):
+        """
+        Record how long a command took to finish. Commands that timed out are recorded with the time waited,
+        so a device that keeps timing out gets a longer timeout. Other failures should not be recorded.
+
+        :param device_id: The device the command was for.
+        :param label: Label of the device, for display.
+        :param seconds: Seconds from sending the command until it finished, or until it timed out.
+        """
+        latency = self.devices.get(device_id)
+        if latency is None:
+            latency = self.devices[device_id] = DeviceLatency(label)
+        latency.record(seconds, self.alpha)
+
+    def expected(self, device_id):
+        """
+        Return the seconds a command for the device is expected to take, the moving average.
+        """
+        latency = self.devices.get(device_id)
+        if latency is None or latency.histogram.count < self.min_samples:
+            return None
+        return latency.ewma
+
+    def timeout(self, device_id):
+        """
+        Return the command timeout for the device, in seconds.
+        """
+        latency = self.devices.get(device_id)
+        if latency is None or latency.histogram.count < self.min_samples:
+            return self.default_timeout
+        timeout = max(latency.histogram.percentile(99), latency.ewma) * self.multiplier
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def summary(self):
+        """
+        Summary of each device, ordered by label. Times are in milliseconds, the timeout is in seconds.
+
+        :return: dict of device_id -> summary
+        """
+        results = OrderedDict()
+        for device_id, latency in sorted(self.devices.items(), key=lambda item: item[1].label):
+            summary = latency.histogram.summary()
+            summary['label'] = latency.label
+            summary['ewma'] = round(latency.ewma * 1000, 3)
+            summary['timeout'] = round(self.timeout(device_id), 2)
+            results[device_id] = summary
+        return results
+
+    def clear(self):
+        self.devices.clear()
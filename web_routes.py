@@ -1,8 +1,10 @@
 import json
+from time import perf_counter
 
 from twisted.internet.defer import inlineCallbacks
 
 from yombo.core.exceptions import YomboWarning
+from yombo.modules.amazonalexa import codec
 from yombo.lib.webinterface.routes.api_v1.__init__ import return_good, return_not_found, return_error, return_unauthorized
 from yombo.core.log import get_logger
 from yombo.lib.webinterface.auth import require_auth
@@ -46,6 +48,7 @@ def module_amazonalexa_routes(webapp):
 
         @webapp.route("/amazonalexa/index", methods=['POST'])
         @require_auth(access_platform="module_amazonalexa", access_item="*", access_action="manage")
+        @inlineCallbacks
         def page_module_amazonalexa_index_post(webinterface, request, session):
             amazonalexa = webinterface._Modules['AmazonAlexa']
             if amazonalexa.node is None:
@@ -57,30 +60,25 @@ def module_amazonalexa_routes(webapp):
                 json_output = request.args.get('json_output', [{}])[0]
                 json_output = json.loads(json_output)
                 # print("json_out: %s" % json_output)
-                if 'devices' not in amazonalexa.node.data:
-                    amazonalexa.node.data['devices'] = {}
-                if 'scenes' not in amazonalexa.node.data:
-                    amazonalexa.node.data['scenes'] = {}
-                devices_allowed = []
-                scenes_allowed = []
+                devices_allowed = set()
+                scenes_allowed = set()
                 for item_id, value in json_output.items():
                     if value == '1':
                         if item_id.startswith("deviceid_"):
                             parts = item_id.split('_')
                             item_id = parts[1]
                             if item_id in amazonalexa._Devices:
-                                devices_allowed.append(parts[1])
+                                devices_allowed.add(parts[1])
                         if item_id.startswith("sceneid_"):
                             parts = item_id.split('_')
                             item_id = parts[1]
                             if item_id in amazonalexa._Scenes:
-                                scenes_allowed.append(parts[1])
+                                scenes_allowed.add(parts[1])
 
-                # if 'allowed' not in amazonalexa.node.data:
-                #     amazonalexa.node.data['devices']['allowed'] = {}
-                amazonalexa.node.data['devices']['allowed'] = devices_allowed
-                amazonalexa.node.data['scenes']['allowed'] = scenes_allowed
-                amazonalexa.discovery(save=False)
+                devices_added, devices_removed = amazonalexa.allowed_devices.replace(devices_allowed)
+                scenes_added, scenes_removed = amazonalexa.allowed_scenes.replace(scenes_allowed)
+                yield amazonalexa.discovery(device_ids=devices_added | devices_removed,
+                                            scene_ids=scenes_added | scenes_removed)
 
             page = webinterface.webapp.templates.get_template('modules/amazonalexa/web/index.html')
             root_breadcrumb(webinterface, request)
@@ -97,28 +95,57 @@ def module_amazonalexa_routes(webapp):
         def page_module_amazonalexa_control_post(webinterface, request, session):
             session.has_access('device', '*', 'control', raise_error=True)
             amazonalexa = webinterface._Modules['AmazonAlexa']
+            started = perf_counter()
             try:
-                data = json.loads(request.content.read())
+                data = codec.decode(request.content.read())
             except:
                 logger.info("Invalid JSON sent to us, discarding.")
                 return return_error(message="invalid JSON sent", code=400)
-
-            logger.debug("Receiving incoming request data: {data}", data=data)
-
-            message = data['directive']
-            results = yield amazonalexa.get_api_response(message)
-            # print("Alex data control: %s - %s" % (type(data), data))
-            print("sending results: %s" % json.dumps(results))
-            return json.dumps(results)
+            decoded = perf_counter() - started
+
+            if amazonalexa.debug_directives:
+                logger.debug("Receiving incoming request data: {data}", data=data)
+
+            if 'directives' in data:  # Batch mode, responses are returned in the same order.
+                stats_key = 'batch'
+                results = yield amazonalexa.get_api_responses(data['directives'])
+            else:
+                message = data['directive']
+                stats_key = "%s.%s" % (message['header']['namespace'], message['header']['name'])
+                results = yield amazonalexa.get_api_response(message)
+            amazonalexa.directive_stats.record(stats_key, 'decode', decoded)
+            started = perf_counter()
+            output = codec.encode(results)
+            amazonalexa.directive_stats.record(stats_key, 'encode', perf_counter() - started)
+            if amazonalexa.debug_directives:
+                logger.debug("Sending results: {results}", results=output.decode())
+            return output
+
+        @webapp.route("/alexa/stats", methods=['GET'])
+        @require_auth(api=True, access_platform="module_amazonalexa", access_item="*", access_action="manage")
+        def page_module_amazonalexa_stats_get(webinterface, request, session):
+            amazonalexa = webinterface._Modules['AmazonAlexa']
+            return return_good(request, payload={
+                'directives': amazonalexa.directive_stats.summary(),
+                'commands': amazonalexa.command_scheduler.stats(),
+                'device_latency': amazonalexa.command_scheduler.latencies.summary(),
+                'rejected': amazonalexa.admission_control.rejected,
+                'circuit_breakers': amazonalexa.circuit_breakers.summary(),
+                'idempotency': {
+                    'size': len(amazonalexa.idempotency_cache),
+                    'hits': amazonalexa.idempotency_cache.hits,
+                },
+            })
 
         @webapp.route("/alexa/reportstate", methods=['POST'])
         @require_auth(api=True, access_platform="module_amazonalexa", access_item="*", access_action="api")
+        @inlineCallbacks
         def page_module_amazonalexa_reportstate_post(webinterface, request, session):
             amazonalexa = webinterface._Modules['AmazonAlexa']
             try:
-                data = json.loads(request.content.read())
+                data = codec.decode(request.content.read())
             except:
                 return return_error(message="invalid JSON sent", code=400)
 
-            # print("Alex data: %s - %s" % (type(data), data))
-            return "yes"
+            results = yield amazonalexa.get_api_response(data['directive'])
+            return codec.encode(results)